@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# Mide cuánta memoria ocupa en el servidor HFTP cada conexión ociosa.
+#
+# Abre muchas conexiones contra un server ya lanzado, hace un pedido chico
+# en cada una y las deja abiertas sin hacer nada. Compara la memoria
+# residente del server (que informa el comando stats) antes y después.
+
+import optparse
+import resource
+import socket
+import sys
+import time
+import client
+from constants import *
+
+
+def open_connection(options):
+    """
+    Abre una conexión cruda al server, hace un pedido chico y devuelve
+    el socket, que queda ocioso.
+    """
+    if options.unix_socket is not None:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(options.unix_socket)
+    else:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((options.address, options.port))
+    s.sendall(("get_metadata does_not_exist" + EOL).encode("ascii"))
+    response = b""
+    while not response.endswith(EOL.encode("ascii")):
+        data = s.recv(4096)
+        if not data:
+            raise ConnectionError("el server cerró la conexión: %r" % response)
+        response += data
+    return s
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-a", "--address", default=DEFAULT_ADDR,
+                      help="Dirección del server")
+    parser.add_option("-p", "--port", type="int", default=DEFAULT_PORT,
+                      help="Puerto TCP del server")
+    parser.add_option("-u", "--unix-socket", default=None,
+                      help="Socket Unix del server, en lugar de TCP")
+    parser.add_option("-n", "--connections", type="int", default=1000,
+                      help="Cantidad de conexiones ociosas a abrir")
+    parser.add_option("--settle", type="float", default=1.0,
+                      help="Segundos a esperar antes de medir")
+    options, args = parser.parse_args()
+    if args or options.connections <= 0:
+        parser.print_help()
+        sys.exit(1)
+
+    # Cada conexión ocupa un descriptor también de este lado
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < options.connections + 16:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    control = client.Client(options.address, options.port,
+                            unix_path=options.unix_socket)
+    before = control.stats()
+    start = time.perf_counter()
+    sockets = []
+    try:
+        for i in range(options.connections):
+            sockets.append(open_connection(options))
+        elapsed = time.perf_counter() - start
+        time.sleep(options.settle)
+        after = control.stats()
+    finally:
+        for s in sockets:
+            s.close()
+    control.close()
+
+    n = len(sockets)
+    rss_before = before.get("process_resident_memory_bytes", 0)
+    rss_after = after.get("process_resident_memory_bytes", 0)
+    print("conexiones:          %d (abiertas en %.2fs)" % (n, elapsed))
+    print("hilos del server:    %d -> %d" % (before.get("hftp_threads", 0),
+                                            after.get("hftp_threads", 0)))
+    print("RSS del server:      %.1f MiB -> %.1f MiB" % (rss_before / 2**20,
+                                                         rss_after / 2**20))
+    print("memoria por conexión: %.1f KiB" % ((rss_after - rss_before) / n / 1024))
+
+
+if __name__ == '__main__':
+    main()
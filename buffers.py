@@ -0,0 +1,46 @@
+# encoding: utf-8
+# Buffers de lectura compartidos por las conexiones del servidor HFTP.
+
+from constants import READ_BUFFER_SIZE, MAX_FREE_BUFFERS
+
+
+class BufferPool(object):
+    """
+    Buffers de `size' bytes para recv_into(), reutilizados entre
+    conexiones. Una conexión toma un buffer solo mientras lee, así que
+    hacen falta tantos como lecturas simultáneas y no uno por conexión.
+    """
+
+    __slots__ = ("size", "max_free", "free")
+
+    def __init__(self, size, max_free):
+        """
+        Args:
+            size (int): Tamaño de cada buffer.
+            max_free (int): Buffers libres que se guardan como mucho; los
+                que sobran se liberan.
+        """
+        self.size = size
+        self.max_free = max_free
+        self.free = []
+
+    def acquire(self):
+        """
+        Devuelve un buffer libre, o uno nuevo si no hay.
+        """
+        try:
+            # list.pop y list.append son atómicas: no hace falta un lock
+            return self.free.pop()
+        except IndexError:
+            return bytearray(self.size)
+
+    def release(self, buffer):
+        """
+        Devuelve al pool un buffer obtenido con acquire().
+        """
+        if len(self.free) < self.max_free:
+            self.free.append(buffer)
+
+
+# Pool compartido por todas las conexiones del proceso
+read_buffers = BufferPool(READ_BUFFER_SIZE, MAX_FREE_BUFFERS)
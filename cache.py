@@ -0,0 +1,99 @@
+# encoding: utf-8
+# Caché local y persistente de archivos para el cliente HFTP.
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+
+class FileCache(object):
+    """
+    Directorio con copias de archivos bajados, indexadas por su identidad:
+    servidor, nombre, tamaño y fecha de modificación en el servidor. Si la
+    identidad no cambió, la copia sirve y no hace falta volver a bajarla.
+
+    Cada entrada es un archivo del directorio cuyo nombre es un hash de la
+    identidad, así el índice sobrevive entre ejecuciones sin archivos
+    aparte. La fecha de modificación de la entrada marca su último uso: al
+    superar `budget' bytes se descartan las menos usadas recientemente.
+    """
+
+    def __init__(self, directory, budget):
+        """
+        Args:
+            directory (str): Directorio de la caché. Se crea si no existe.
+            budget (int): Bytes que puede ocupar la caché en total.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.budget = budget
+
+    @staticmethod
+    def key(server, filename, size, mtime_ns):
+        """
+        Devuelve la clave de la caché para una identidad de archivo.
+        """
+        identity = "%s\0%s\0%d\0%d" % (server, filename, size, mtime_ns)
+        return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def fetch(self, key, destination):
+        """
+        Copia la entrada `key' a `destination', si existe.
+
+        Returns:
+            True si la entrada estaba en la caché.
+        """
+        path = self._path(key)
+        try:
+            shutil.copyfile(path, destination)
+            # Marca la entrada como usada recientemente
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def store(self, key, source):
+        """
+        Guarda una copia del archivo `source' como la entrada `key' y
+        descarta entradas viejas si se excede el presupuesto.
+        """
+        if os.path.getsize(source) > self.budget:
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        os.close(fd)
+        try:
+            shutil.copyfile(source, tmp)
+            # El reemplazo es atómico: nunca se ve una entrada a medio escribir
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Descarta las entradas usadas hace más tiempo hasta que la caché
+        ocupe como mucho `budget' bytes.
+        """
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+                st = entry.stat()
+                entries.append((st.st_mtime_ns, st.st_size, entry.path))
+                total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.budget:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -9,34 +9,89 @@
 import socket
 import logging
 import optparse
+import os
 import sys
 import time
+import collections
 from base64 import b64decode
 from constants import *
+from cache import FileCache
+from framing import (PROTOCOL_V1, PROTOCOL_V2, FLAG_MORE, encode_request,
+                     decode_response)
 
 
 class Client(object):
 
-    def __init__(self, server=DEFAULT_ADDR, port=DEFAULT_PORT):
+    def __init__(self, server=DEFAULT_ADDR, port=DEFAULT_PORT,
+                 protocol=PROTOCOL_V1, cache=None, unix_path=None):
         """
         Nuevo cliente, conectado al `server' solicitado en el `port' TCP
         indicado.
 
+        Si `protocol' es PROTOCOL_V2 intenta pasar a la versión 2 del
+        protocolo (ver framing.py); si el server no la soporta sigue en la
+        versión 1.
+
+        Si se indica `cache' (un FileCache), retrieve() reutiliza las
+        copias de archivos que no cambiaron en el server.
+
+        Si se indica `unix_path', se conecta al socket Unix en esa ruta en
+        lugar de usar TCP (para un server en la misma máquina).
+
         Si falla la conexión, genera una excepción de socket.
         """
-        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.status = None
-        self.s.connect((server, port))
-        self.buffer = ''
+        if unix_path is not None:
+            self.s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.s.connect(unix_path)
+            self.server = "unix:%s" % unix_path
+        else:
+            self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.s.connect((server, port))
+            self.server = "%s:%s" % (server, port)
+        self.cache = cache
+        # Bytes recibidos sin procesar, y hasta dónde ya se buscó el fin de línea
+        self.buffer = bytearray()
+        self.scanned = 0
         self.connected = True
+        self.protocol = PROTOCOL_V1
+        # Próximo id de pedido y frames ya recibidos de pedidos que todavía
+        # nadie reclamó (en la versión 2 pueden llegar en otro orden)
+        self.next_id = 1
+        self.responses = {}
+        # Suscripción a los cambios del directorio: id del pedido watch
+        # (versión 2) y eventos ya recibidos que todavía nadie leyó
+        self.watching = False
+        self.watch_id = None
+        self.events = collections.deque()
+        if protocol == PROTOCOL_V2:
+            self.negotiate()
+
+    def negotiate(self):
+        """
+        Pide al server pasar a la versión 2 del protocolo.
+
+        Devuelve True si el server aceptó.
+        """
+        self.send('protocol %d' % PROTOCOL_V2)
+        self.status, message = self.read_response_line()
+        if self.status == CODE_OK:
+            self.protocol = PROTOCOL_V2
+            return True
+        logging.warning("El server no soporta la versión 2 del protocolo "
+                        "(code=%s %s)." % (self.status, message))
+        return False
 
     def close(self):
         """
         Desconecta al cliente del server, mandando el mensaje apropiado
         antes de desconectar.
         """
-        self.send('quit')
-        self.status, message = self.read_response_line()
+        if self.protocol == PROTOCOL_V2:
+            self.status, message = self.request('quit')
+        else:
+            self.send('quit')
+            self.status, message = self.read_response_line()
         if self.status != CODE_OK:
             logging.warning("Warning: quit no contesto ok, sino '%s'(%s)'."
                             % (message, self.status))
@@ -68,7 +123,7 @@ class Client(object):
         Para uso privado del cliente.
         """
         self.s.settimeout(timeout)
-        data = self.s.recv(4096).decode("ascii")
+        data = self.s.recv(2**16)
         self.buffer += data
 
         if len(data) == 0:
@@ -83,7 +138,18 @@ class Client(object):
         Devuelve la línea, eliminando el terminaodr y los espacios en blanco
         al principio y al final.
         """
-        while not EOL in self.buffer and self.connected:
+        eol = EOL.encode("ascii")
+        while True:
+            pos = self.buffer.find(eol, self.scanned)
+            if pos >= 0:
+                response = bytes(self.buffer[:pos])
+                del self.buffer[:pos + len(eol)]
+                self.scanned = 0
+                return response.decode("ascii").strip()
+            if not self.connected:
+                break
+            # El terminador podría quedar partido entre dos recv
+            self.scanned = max(len(self.buffer) - len(eol) + 1, 0)
             if timeout is not None:
                 t1 = time.process_time()
             self._recv(timeout)
@@ -91,12 +157,8 @@ class Client(object):
                 t2 = time.process_time()
                 timeout -= t2 - t1
                 t1 = t2
-        if EOL in self.buffer:
-            response, self.buffer = self.buffer.split(EOL, 1)
-            return response.strip()
-        else:
-            self.connected = False
-            return ""
+        self.connected = False
+        return ""
 
     def read_response_line(self, timeout=None):
         """
@@ -107,6 +169,10 @@ class Client(object):
         """
         result = None, None
         response = self.read_line(timeout)
+        # Con watch, antes de la respuesta pueden llegar eventos
+        while self.watching and response and not response[0].isdigit():
+            self.events.append(self._parse_event(response))
+            response = self.read_line(timeout)
         if ' ' in response:
             code, message = response.split(None, 1)
             try:
@@ -121,23 +187,130 @@ class Client(object):
         """
         Espera y lee un fragmento de un archivo.
 
-        Devuelve el contenido del fragmento.
+        Devuelve el contenido del fragmento. Si el server corta la conexión
+        antes de enviarlo completo, deja self.status en None.
         """
         # Ahora, esperamos hasta tener la cantidad de datos necesaria
         data = self.read_line()
         fragment = b64decode(data)
         while len(fragment) < length:
+            if not self.connected:
+                # El server cortó la conexión a mitad del fragmento
+                logging.warning("Fragmento truncado: %d de %d bytes"
+                                % (len(fragment), length))
+                self.status = None
+                break
             data = self.read_line()
             fragment += b64decode(data)
 
         return fragment
 
+    def submit(self, command, timeout=None):
+        """
+        Envía un pedido en la versión 2 del protocolo sin esperar la
+        respuesta. Devuelve el id del pedido.
+        """
+        request_id = self.next_id
+        self.next_id = self.next_id % 0xffffffff + 1
+        self.s.settimeout(timeout)
+        logging.debug("Enviando el pedido %d: %s" % (request_id, command))
+        self.s.sendall(encode_request(request_id, command))
+        return request_id
+
+    def read_frame(self, timeout=None):
+        """
+        Espera un frame de respuesta de la versión 2 del protocolo.
+
+        Devuelve una tupla (id, código, flags, datos), o None si el server
+        cerró la conexión.
+        """
+        while True:
+            frame = decode_response(self.buffer, MAX_BUFFER_SIZE)
+            if frame is not None:
+                return frame
+            if not self.connected:
+                return None
+            self._recv(timeout)
+
+    def iter_response(self, request_id, timeout=None):
+        """
+        Generador de los frames de la respuesta al pedido `request_id', como
+        pares (código, datos). Los frames de otros pedidos que lleguen
+        mientras tanto se guardan para cuando se los pida.
+
+        Si se pierde la conexión antes del último frame, termina con el par
+        (None, b""): la respuesta quedó incompleta.
+        """
+        while True:
+            frame = self._next_frame(request_id, timeout)
+            if frame is None:
+                yield None, b""
+                return
+            code, flags, payload = frame
+            yield code, payload
+            if not flags & FLAG_MORE:
+                return
+
+    def _next_frame(self, request_id, timeout=None):
+        """
+        Devuelve el próximo frame del pedido `request_id', como una tupla
+        (código, flags, datos), o None si se perdió la conexión.
+        """
+        while True:
+            pending = self.responses.get(request_id)
+            if pending:
+                frame = pending.popleft()
+                if not pending:
+                    del self.responses[request_id]
+                return frame
+            frame = self.read_frame(timeout)
+            if frame is None:
+                self.connected = False
+                return None
+            frame_id, code, flags, payload = frame
+            if frame_id == request_id:
+                return code, flags, payload
+            self.responses.setdefault(
+                frame_id, collections.deque()).append((code, flags, payload))
+
+    def wait_response(self, request_id, timeout=None):
+        """
+        Espera la respuesta completa al pedido `request_id' de la versión 2
+        del protocolo.
+
+        Devuelve un par (código, datos), o (None, None) si se perdió la
+        conexión antes de terminar la respuesta. En las respuestas de error
+        los datos son el mensaje.
+        """
+        code = None
+        data = bytearray()
+        for frame_code, payload in self.iter_response(request_id, timeout):
+            if frame_code is None:
+                return None, None
+            if code is None:
+                code = frame_code
+            data += payload
+        return code, bytes(data)
+
+    def request(self, command, timeout=None):
+        """
+        Envía un pedido en la versión 2 del protocolo y espera su respuesta.
+        Devuelve lo mismo que wait_response().
+        """
+        return self.wait_response(self.submit(command, timeout), timeout)
+
     def file_lookup(self):
         """
         Obtener el listado de archivos en el server. Devuelve una lista
         de strings.
         """
         result = []
+        if self.protocol == PROTOCOL_V2:
+            self.status, data = self.request('get_file_listing')
+            if self.status == CODE_OK:
+                # Los nombres terminan en EOL y el listado en una línea vacía
+                result = data.decode("ascii").split(EOL)[:-2]
+            return result
         self.send('get_file_listing')
         print("Enviado get_file_listing")
         self.status, message = self.read_response_line()
@@ -154,17 +327,196 @@ class Client(object):
 
         return result
 
+    def list_files(self, cursor="0", limit=DEFAULT_PAGE_SIZE, pattern=None):
+        """
+        Obtiene una página del listado de archivos del server.
+
+        Devuelve un par (nombres, cursor): el cursor sirve para pedir la
+        página siguiente y es "0" si no quedan más. Con un patrón la página
+        puede venir corta, o vacía, aunque queden más. En caso de error
+        devuelve ([], "0").
+        """
+        command = 'list_files %s %d' % (cursor, limit)
+        if pattern is not None:
+            command += ' ' + pattern
+        if self.protocol == PROTOCOL_V2:
+            self.status, data = self.request(command)
+            if self.status != CODE_OK:
+                return [], "0"
+            lines = data.decode("ascii").split(EOL)
+            return lines[1:-2], lines[0]
+        self.send(command)
+        self.status, message = self.read_response_line()
+        if self.status != CODE_OK:
+            logging.warning("Falló la solicitud de la lista de archivos" +
+                            "(code=%s %s)." % (self.status, message))
+            return [], "0"
+        cursor = self.read_line()
+        names = []
+        filename = self.read_line()
+        while filename:
+            names.append(filename)
+            filename = self.read_line()
+        return names, cursor
+
+    def iter_files(self, pattern=None, page_size=DEFAULT_PAGE_SIZE):
+        """
+        Generador de los nombres de los archivos del server que cumplen el
+        patrón glob `pattern'. Los pide de a páginas de `page_size', así
+        que sirve para directorios enormes.
+        """
+        names, cursor = self.list_files("0", page_size, pattern)
+        while True:
+            for name in names:
+                yield name
+            if cursor == "0":
+                return
+            names, cursor = self.list_files(cursor, page_size)
+
+    def watch(self):
+        """
+        Suscribe al cliente a los cambios del directorio del server. Los
+        eventos se leen con read_event().
+
+        Devuelve True si el server aceptó.
+        """
+        if self.protocol == PROTOCOL_V2:
+            request_id = self.submit('watch')
+            frame = self._next_frame(request_id)
+            self.status = frame[0] if frame is not None else None
+            self.watch_id = request_id
+        else:
+            self.send('watch')
+            self.status, message = self.read_response_line()
+        self.watching = self.status == CODE_OK
+        return self.watching
+
+    def read_event(self, timeout=None):
+        """
+        Espera el próximo cambio en el directorio del server.
+
+        Devuelve un par (evento, nombre), con evento "add", "modify" o
+        "delete", o ("overflow", None) si se perdieron eventos. Devuelve
+        None si terminó la suscripción. Si se da un timeout, puede abortar
+        con una excepción socket.timeout.
+        """
+        if self.events:
+            return self.events.popleft()
+        if not self.watching:
+            return None
+        if self.protocol == PROTOCOL_V2:
+            frame = self._next_frame(self.watch_id, timeout)
+            if frame is None or not frame[1] & FLAG_MORE:
+                self.watching = False
+                return None
+            return self._parse_event(frame[2].decode("ascii"))
+        line = self.read_line(timeout)
+        if not line:
+            return None
+        return self._parse_event(line)
+
+    def unwatch(self):
+        """
+        Termina la suscripción a los cambios del directorio. Los eventos
+        que llegaron antes se pueden seguir leyendo con read_event().
+        """
+        if self.protocol == PROTOCOL_V2:
+            request_id = self.submit('unwatch')
+            self.status, message = self.wait_response(request_id)
+            # Los eventos que quedaron antes del fin de la respuesta a watch
+            for code, payload in self.iter_response(self.watch_id):
+                if payload:
+                    self.events.append(self._parse_event(payload.decode("ascii")))
+        else:
+            self.send('unwatch')
+            self.status, message = self.read_response_line()
+        self.watching = False
+
+    @staticmethod
+    def _parse_event(line):
+        event, _, name = line.partition(' ')
+        return event, name or None
+
+    def profile(self, *args):
+        """
+        Envía el comando de administración profile con los argumentos
+        dados, por ejemplo profile('start', 'sample', 10). Solo lo aceptan
+        los servers locales.
+
+        Devuelve la línea de respuesta (la ruta del resultado, para start
+        y stop), o None en caso de error.
+        """
+        command = ' '.join(['profile'] + [str(a) for a in args])
+        if self.protocol == PROTOCOL_V2:
+            self.status, data = self.request(command)
+            return data.decode("ascii") if self.status == CODE_OK else None
+        self.send(command)
+        self.status, message = self.read_response_line()
+        if self.status == CODE_OK:
+            return self.read_line()
+        return None
+
+    def stats(self):
+        """
+        Obtiene las métricas del server. Devuelve un diccionario que
+        asocia el nombre de cada serie (con sus etiquetas) a su valor.
+        """
+        result = {}
+        if self.protocol == PROTOCOL_V2:
+            self.status, message = self.request('stats')
+            lines = message.decode("ascii").split(EOL) if self.status == CODE_OK else []
+        else:
+            self.send('stats')
+            self.status, message = self.read_response_line()
+            lines = []
+            if self.status == CODE_OK:
+                line = self.read_line()
+                while line:
+                    lines.append(line)
+                    line = self.read_line()
+        for line in lines:
+            if line and not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                result[name] = float(value)
+        if self.status != CODE_OK:
+            logging.warning("Falló la solicitud de métricas "
+                            "(code=%s %s)." % (self.status, message))
+        return result
+
     def get_metadata(self, filename):
         """
         Obtiene en el server el tamaño del archivo con el nombre dado.
         Devuelve None en caso de error.
         """
+        if self.protocol == PROTOCOL_V2:
+            self.status, data = self.request('get_metadata %s' % filename)
+            if self.status == CODE_OK:
+                return int(data)
+            return None
         self.send('get_metadata %s' % filename)
         self.status, message = self.read_response_line()
         if self.status == CODE_OK:
             size = int(self.read_line())
             return size
 
+    def get_identity(self, filename):
+        """
+        Obtiene en el server la identidad del archivo con el nombre dado:
+        un par (tamaño, fecha de modificación en nanosegundos). Devuelve
+        None en caso de error.
+        """
+        if self.protocol == PROTOCOL_V2:
+            self.status, data = self.request('get_identity %s' % filename)
+            line = data.decode("ascii") if self.status == CODE_OK else None
+        else:
+            self.send('get_identity %s' % filename)
+            self.status, message = self.read_response_line()
+            line = self.read_line() if self.status == CODE_OK else None
+        if line is None:
+            return None
+        size, mtime_ns = line.split()
+        return int(size), int(mtime_ns)
+
     def get_slice(self, filename, start, length):
         """
         Obtiene un trozo de un archivo en el server.
@@ -172,21 +524,65 @@ class Client(object):
         El archivo es guardado localmente, en el directorio actual, con el
         mismo nombre que tiene en el server.
         """
+        if self.protocol == PROTOCOL_V2:
+            self._get_slice_v2(filename, start, length)
+            return
         self.send('get_slice %s %d %d' % (filename, start, length))
         self.status, message = self.read_response_line()
         if self.status == CODE_OK:
-            output = open(filename, 'wb')
             fragment = self.read_fragment(length)
+            if self.status != CODE_OK:
+                # Slice incompleto: no se escribe el archivo
+                return
+            output = open(filename, 'wb')
             output.write(fragment)
             output.close()
         else:
             logging.warning("El servidor indico un error al leer de %s."
                             % filename)
 
+    def _get_slice_v2(self, filename, start, length):
+        """
+        get_slice en la versión 2 del protocolo: los datos llegan crudos y
+        se escriben en el archivo a medida que llegan los frames.
+        """
+        self.status = None
+        output = None
+        request_id = self.submit('get_slice %s %d %d' % (filename, start, length))
+        for code, payload in self.iter_response(request_id):
+            if code is None:
+                # Se cortó la conexión a mitad del slice: no hay archivo
+                self.status = None
+                if output is not None:
+                    output.close()
+                    os.remove(filename)
+                logging.warning("Slice incompleto de %s." % filename)
+                return
+            if self.status is None:
+                self.status = code
+                if code == CODE_OK:
+                    output = open(filename, 'wb')
+            if output is not None:
+                output.write(payload)
+        if output is not None:
+            output.close()
+        else:
+            logging.warning("El servidor indico un error al leer de %s."
+                            % filename)
+
     def retrieve(self, filename):
         """
         Obtiene un archivo completo desde el servidor.
+
+        Con caché, primero pide la identidad del archivo: si hay una copia
+        con la misma identidad la usa sin bajar nada.
         """
+        if self.cache is not None:
+            identity = self.get_identity(filename)
+            # Con un server viejo, que no conoce get_identity, bajamos sin caché
+            if self.status != INVALID_COMMAND:
+                self._retrieve_cached(filename, identity)
+                return
         size = self.get_metadata(filename)
         if self.status == CODE_OK:
             assert size >= 0
@@ -197,6 +593,27 @@ class Client(object):
             logging.warning("No se pudo obtener el archivo %s (code=%s)."
                             % (filename, self.status))
 
+    def _retrieve_cached(self, filename, identity):
+        """
+        retrieve() con caché, una vez obtenida la identidad del archivo.
+        """
+        if self.status == FILE_NOT_FOUND:
+            logging.info("El archivo solicitado no existe.")
+            return
+        if self.status != CODE_OK:
+            logging.warning("No se pudo obtener el archivo %s (code=%s)."
+                            % (filename, self.status))
+            return
+        key = FileCache.key(self.server, filename, *identity)
+        if self.cache.fetch(key, filename):
+            logging.info("%s obtenido de la caché." % filename)
+            return
+        self.get_slice(filename, 0, identity[0])
+        # Solo se guarda una copia completa: otra quedaría asociada a la
+        # identidad del archivo entero
+        if self.status == CODE_OK and os.path.getsize(filename) == identity[0]:
+            self.cache.store(key, filename)
+
 
 def main():
     """
@@ -210,13 +627,24 @@ def main():
                     }
 
     # Parsear argumentos
-    parser = optparse.OptionParser(usage="%prog [options] server")
+    parser = optparse.OptionParser(usage="%prog [options] server\n"
+                                   "       %prog [options] -u socket")
     parser.add_option("-p", "--port",
                       help="Numero de puerto TCP donde escuchar", default=DEFAULT_PORT)
     parser.add_option("-v", "--verbose", dest="level", action="store",
                       help="Determina cuanta informacion de depuracion a mostrar"
                       "(valores posibles son: ERROR, WARN, INFO, DEBUG)",
                       default="ERROR")
+    parser.add_option("--protocol", type="int", default=PROTOCOL_V1,
+                      help="Versión del protocolo a usar (1 o 2)")
+    parser.add_option("-u", "--unix-socket", default=None,
+                      help="Conectarse al socket Unix en esta ruta en lugar "
+                      "de usar TCP")
+    parser.add_option("--cache-dir", default=None,
+                      help="Directorio donde guardar los archivos bajados "
+                      "para no volver a bajarlos si no cambiaron")
+    parser.add_option("--cache-size", type="int", default=DEFAULT_CACHE_SIZE,
+                      help="Bytes que puede ocupar la caché")
     options, args = parser.parse_args()
     try:
         port = int(options.port)
@@ -226,7 +654,8 @@ def main():
         parser.print_help()
         sys.exit(1)
 
-    if len(args) != 1 or options.level not in list(DEBUG_LEVELS.keys()):
+    nargs = 0 if options.unix_socket is not None else 1
+    if len(args) != nargs or options.level not in list(DEBUG_LEVELS.keys()):
         parser.print_help()
         sys.exit(1)
 
@@ -235,7 +664,12 @@ def main():
     logging.getLogger().setLevel(code_level)
 
     try:
-        client = Client(args[0], port)
+        cache = None
+        if options.cache_dir is not None:
+            cache = FileCache(options.cache_dir, options.cache_size)
+        server = args[0] if args else None
+        client = Client(server, port, options.protocol, cache,
+                        options.unix_socket)
     except(socket.error, socket.gaierror):
         sys.stderr.write("Error al conectarse\n")
         sys.exit(1)
@@ -244,10 +678,12 @@ def main():
           "the Home-made File Transfer Protocol *\n"
           "* Estan disponibles los siguientes archivos:")
 
-    files = client.file_lookup()
-
-    for filename in files:
+    for filename in client.iter_files():
         print(filename)
+    if client.status == INVALID_COMMAND:
+        # El server no tiene list_files: pedimos el listado completo
+        for filename in client.file_lookup():
+            print(filename)
 
     print("Status client %s" % client.status)
     if client.status == CODE_OK:
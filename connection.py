@@ -5,26 +5,171 @@
 
 import socket
 import os
+import collections
 from constants import *
 from base64 import b64encode
 import logging
+import tempfile
+import threading
+import time
+from metrics import Metrics
+from hftplog import access_log
+from outqueue import OutputQueue, poll_socket
+from executor import command_class, INLINE
+from watcher import DirectoryWatcher
+from buffers import read_buffers
+from profiler import Profiler
+from listing import DirectoryCursor
+from framing import (PROTOCOL_V1, PROTOCOL_V2, FLAG_MORE, decode_request,
+                     encode_response_header)
 
 # Importo libreria para usar sleep
 
+logger = logging.getLogger("hftp.connection")
+
+
+class RequestState(threading.local):
+    """
+    Estado del pedido que se está atendiendo. Es propio de cada hilo,
+    porque con los pools de ejecución varios pedidos de una misma conexión
+    pueden atenderse a la vez. Como cada hilo atiende un solo pedido por
+    vez, una única instancia sirve para todas las conexiones.
+    """
+
+    def __init__(self):
+        # Id del pedido (versión 2 del protocolo)
+        self.id = 0
+        # Último código de respuesta enviado, para las métricas
+        self.code = CODE_OK
+        # Último frame de la respuesta, todavía sin enviar (versión 2)
+        self.pending = None
+        # Bytes enviados, para el access log
+        self.nbytes = 0
+        # Segundos por etapa (parse, validate, read, encode, send), o None
+        # si no se están midiendo
+        self.spans = None
+
+
+class Job(object):
+    """
+    Pedido cuya respuesta se produce de a partes (un slice, el listado
+    completo), con lo necesario para suspenderla cuando la cola de salida
+    se llena y reanudarla después en otro hilo.
+    """
+
+    __slots__ = ("producer", "cmd", "arg", "start", "state")
+
+    def __init__(self, cmd, arg, start):
+        # Generador que produce la respuesta (ver _produce()), o None
+        self.producer = None
+        # Comando, primer argumento y comienzo, para las métricas y el log
+        self.cmd = cmd
+        self.arg = arg
+        self.start = start
+        # Copia del RequestState del pedido mientras está suspendido
+        self.state = None
+
 
 class Connection(object):
     """
     Conexión punto a punto entre el servidor y un cliente.
     Se encarga de satisfacer los pedidos del cliente hasta
     que termina la conexión.
+
+    Un servidor puede tener muchísimas conexiones ociosas, así que cada una
+    ocupa lo mínimo: sin __dict__, y lo que solo hace falta para algunos
+    comandos (watch, pedidos concurrentes) se crea recién al usarse.
     """
 
-    def __init__(self, socket, directory):
+    __slots__ = ("socket", "directory", "connect", "buffer", "scanned",
+                 "protocol", "metrics", "peer", "shaper", "idle_timeout",
+                 "request_timeout", "send_timeout", "request_started",
+                 "idle_since",
+                 "output", "output_lock", "writable", "cursors", "cursors_lock",
+                 "next_cursor",
+                 "executors", "inflight", "inflight_lock", "suspended",
+                 "send_since", "watcher",
+                 "watching", "watch_id", "events", "events_lock",
+                 "events_lost", "wakeup", "profiler", "draining")
+
+    # Estado del pedido en curso, propio de cada hilo
+    request = RequestState()
+
+    def __init__(self, socket, directory, metrics=None, peer=None, shaper=None,
+                 idle_timeout=None, request_timeout=None, send_timeout=None,
+                 high_watermark=DEFAULT_HIGH_WATERMARK,
+                 low_watermark=DEFAULT_LOW_WATERMARK, executors=None,
+                 watcher=None, profiler=None):
         # FALTA: Inicializar atributos de Connection
         self.socket = socket
         self.directory = directory
         self.connect = True
-        self.buffer = ""
+        # En un reinicio ordenado: terminar los pedidos en curso y cerrar
+        self.draining = False
+        # Bytes recibidos todavía sin procesar, y hasta dónde ya se buscó
+        # el fin de línea en ellos (para no volver a recorrerlos). Sin
+        # datos pendientes es b"", que no ocupa memoria propia.
+        self.buffer = b""
+        self.scanned = 0
+        # Versión del protocolo que habla la conexión
+        self.protocol = PROTOCOL_V1
+        # Registro de métricas compartido con el servidor
+        self.metrics = metrics if metrics is not None else Metrics()
+        # Dirección del cliente, para los logs
+        self.peer = "%s:%s" % peer if isinstance(peer, tuple) else str(peer)
+        # Limitador de ancho de banda de los datos enviados (o None)
+        self.shaper = shaper
+        # Timeouts en segundos (None para esperar indefinidamente):
+        # idle_timeout: máximo tiempo sin recibir nada del cliente.
+        # request_timeout: máximo tiempo para completar una línea de pedido
+        #     desde que llega su primer byte.
+        # send_timeout: máximo tiempo bloqueado enviando datos.
+        self.idle_timeout = idle_timeout
+        self.request_timeout = request_timeout
+        self.send_timeout = send_timeout
+        # Momento en que empezó a llegar el pedido incompleto del buffer
+        self.request_started = None
+        # Desde cuándo la conexión no recibe nada ni tiene pedidos en curso
+        self.idle_since = time.monotonic()
+        # El socket no bloquea: las esperas se hacen con wait_socket() y
+        # así cada hilo usa su propio timeout para leer o escribir
+        self.socket.setblocking(False)
+        # Respuestas pendientes de enviar al cliente, compartidas por los
+        # hilos que atienden pedidos de la conexión. Si un envío falla, ya
+        # no tiene sentido encolar más. La cola la envía el hilo de la
+        # conexión; los hilos de los pools solo encolan.
+        self.output = OutputQueue(high_watermark, low_watermark)
+        self.output_lock = threading.RLock()
+        self.writable = True
+        # Desde cuándo hay datos en la cola sin que el cliente lea nada
+        self.send_since = 0.0
+        # Listados paginados abiertos: token -> DirectoryCursor. En la
+        # versión 2 varios hilos de los pools pueden usar la tabla a la vez.
+        self.cursors = {}
+        self.cursors_lock = threading.Lock()
+        self.next_cursor = 1
+        # Pools donde se ejecutan los comandos (None: en el hilo de la
+        # conexión), pedidos en ejecución en ellos y respuestas suspendidas
+        # hasta que la cola de salida baje (ver _produce())
+        self.executors = executors
+        self.inflight = 0
+        self.inflight_lock = None if executors is None else threading.Lock()
+        self.suspended = None
+        # Suscripción a los cambios del directorio (comando watch): id del
+        # pedido watch (versión 2) y eventos pendientes de enviar. Se crean
+        # al pedir watch. El socket para despertar al hilo de la conexión
+        # cuando llega un evento o hay algo para enviar se crea al usarse.
+        self.watcher = (watcher if watcher is not None
+                        else DirectoryWatcher(directory, DEFAULT_WATCH_INTERVAL))
+        self.watching = False
+        self.watch_id = 0
+        self.events = None
+        self.events_lock = None
+        self.events_lost = False
+        self.wakeup = None
+        # Profiling a pedido y medición de etapas de los pedidos
+        self.profiler = (profiler if profiler is not None
+                         else Profiler(tempfile.gettempdir()))
 
     def valid_file(self, filename: str):
         """
@@ -33,14 +178,27 @@ class Connection(object):
             INVALID_ARGUMENTS si el nombre del archivo no es valido.
             FILE_NOT_FOUND si el archivo no existe.
         """
+        start = time.perf_counter()
         # Obtiene los caracteres del nombre del archivo que no pertenecen a VALID_CHARS
         aux = set(filename) - VALID_CHARS
         if os.path.isfile(os.path.join(self.directory, filename)) and len(aux) == 0:
-            return CODE_OK
+            code = CODE_OK
         elif len(aux) != 0:
-            return INVALID_ARGUMENTS
+            code = INVALID_ARGUMENTS
         else:
-            return FILE_NOT_FOUND
+            code = FILE_NOT_FOUND
+        self._span("validate", start)
+        return code
+
+    def _span(self, name: str, start: float):
+        """
+        Suma a la etapa `name' del pedido en curso el tiempo transcurrido
+        desde `start' (un valor de time.perf_counter()), si se están
+        midiendo las etapas.
+        """
+        spans = self.request.spans
+        if spans is not None:
+            spans[name] = spans.get(name, 0.0) + time.perf_counter() - start
 
     def send(self, message, codificacion="ascii"):
         """
@@ -53,24 +211,231 @@ class Connection(object):
         Raises:
             ValueError: Si se especifica una codificación inválida.
         """
-        try:
-            # Verifica y aplica la codificación a utilizar
-            if codificacion == "ascii":
-                message = message.encode("ascii")
-            elif codificacion == "b64encode":
+        # Verifica y aplica la codificación a utilizar
+        start = time.perf_counter()
+        if codificacion == "ascii":
+            message = message.encode("ascii")
+        elif codificacion == "b64encode":
+            # En la versión 2 los datos viajan crudos
+            if self.protocol == PROTOCOL_V1:
                 message = b64encode(message)
+        else:
+            raise ValueError(f"send: codificación inválida '{codificacion}'")
+        self._span("encode", start)
+        if self.protocol == PROTOCOL_V2:
+            self._emit(self.request.code, message)
+        else:
+            # Envía el mensaje junto con el fin de línea
+            self._write(message + EOL.encode("ascii"))
+
+    def send_data(self, data: bytes):
+        """
+        Envía bytes como parte de la respuesta en curso, sin agregarles un
+        fin de línea. Permite enviar una respuesta larga de a partes.
+        """
+        if self.protocol == PROTOCOL_V2:
+            self._emit(self.request.code, data)
+        else:
+            self._write(data)
+
+    def _emit(self, code: int, payload: bytes):
+        """
+        Agrega datos a la respuesta en curso en la versión 2 del protocolo.
+
+        El último frame se retiene hasta saber si le sigue otro, para poder
+        enviarlo sin FLAG_MORE al terminar la respuesta. Un frame vacío
+        seguido de otro con el mismo código no aporta nada y se descarta.
+        """
+        request = self.request
+        if request.pending is not None:
+            pending_code, pending_payload = request.pending
+            if pending_payload or pending_code != code:
+                self._write_frame(pending_code, FLAG_MORE, pending_payload)
+        request.pending = (code, payload)
+
+    def end_response(self):
+        """
+        Termina la respuesta en curso en la versión 2 del protocolo.
+        """
+        request = self.request
+        if request.pending is not None:
+            code, payload = request.pending
+            request.pending = None
+            self._write_frame(code, 0, payload)
+
+    def _write_frame(self, code: int, flags: int, payload: bytes,
+                     request_id=None):
+        """
+        Encola un frame de respuesta al pedido en curso, o al pedido
+        `request_id' si se indica.
+        """
+        if request_id is None:
+            request_id = self.request.id
+        # El encabezado y los datos no pueden separarse con frames de otros hilos
+        with self.output_lock:
+            self._write(encode_response_header(request_id, code, flags,
+                                               len(payload)))
+            self._write(payload)
+
+    def _write(self, data: bytes):
+        """
+        Encola bytes ya codificados para enviar al cliente. No envía nada:
+        la cola la vacía el hilo de la conexión, al que se despierta si
+        estaba vacía. Quien produce una respuesta larga debe dejar de
+        producir cuando la cola supera la marca de agua alta (ver
+        _produce()).
+
+        Para uso privado del servidor.
+        """
+        start = time.perf_counter()
+        self.metrics.add_bytes_out(len(data))
+        self.request.nbytes += len(data)
+        with self.output_lock:
+            if not self.writable or not data:
+                return
+            wake = not self.output.size
+            if wake:
+                self.send_since = time.monotonic()
+            self.output.append(data)
+        if wake:
+            self._wake()
+        self._span("send", start)
+
+    def _drain(self, target=0):
+        """
+        Envía la cola de salida hasta que queden `target' bytes pendientes,
+        bloqueándose. Solo se usa desde el hilo de la conexión, con
+        output_lock tomado.
+
+        Para uso privado del servidor.
+        """
+        try:
+            self.output.drain(self.socket, target, self.send_timeout)
+        except socket.timeout:
+            # El cliente dejó de leer: liberamos la conexión
+            self._stop_sending()
+            self.reclaim("send_timeout")
+        except (BrokenPipeError, ConnectionResetError):
+            self._lost()
+
+    def _send(self, ready):
+        """
+        Envía de la cola de salida lo que el socket acepte sin bloquearse
+        (si `ready', es decir, si la espera no venció), y libera la conexión
+        si hace send_timeout segundos que el cliente no lee. Se llama con
+        output_lock tomado.
+
+        Para uso privado del servidor.
+        """
+        sent = 0
+        try:
+            if ready:
+                sent = self.output.send(self.socket)
+        except (BrokenPipeError, ConnectionResetError):
+            self._lost()
+            return
+        now = time.monotonic()
+        if sent:
+            self.send_since = now
+            if not self.output.size:
+                # Mientras se enviaba la respuesta la conexión no estaba ociosa
+                self.idle_since = now
+        elif self.send_timeout is not None \
+                and now - self.send_since >= self.send_timeout:
+            # El cliente dejó de leer: liberamos la conexión
+            self._stop_sending()
+            self.reclaim("send_timeout")
+
+    def _stop_sending(self):
+        """
+        Descarta la cola de salida y lo que se encole después.
+        """
+        self.output.clear()
+        self.writable = False
+
+    def _lost(self):
+        logger.warning("No se pudo contactar al cliente %s", self.peer)
+        self._stop_sending()
+        self.connect = False
+
+    def _wake(self):
+        """
+        Despierta al hilo de la conexión si está esperando al cliente.
+        """
+        try:
+            self.wakeup[1].send(b"\0")
+        except (OSError, TypeError):
+            # Ya hay un aviso sin leer, o no hay nadie a quien despertar
+            pass
+
+    def _open_wakeup(self):
+        """
+        Crea, si todavía no existe, el socket para despertar al hilo de la
+        conexión.
+        """
+        if self.wakeup is None:
+            self.wakeup = socket.socketpair()
+            for s in self.wakeup:
+                s.setblocking(False)
+
+    def flush(self):
+        """
+        Envía todo lo que quede en la cola de salida.
+        """
+        with self.output_lock:
+            if self.output.size:
+                self._drain(0)
+
+    def send_slice_data(self, f, size: int):
+        """
+        Envía `size' bytes del archivo `f', desde su posición actual,
+        codificados en base64 en una sola línea. En la versión 2 del
+        protocolo los envía crudos, en un frame por chunk.
+
+        Los datos se leen, codifican y envían de a SLICE_CHUNK_SIZE bytes
+        (múltiplo de 3, así la concatenación de los chunks es base64 válido),
+        pasando cada uno por el limitador de ancho de banda. De esta forma
+        un slice grande no ocupa memoria proporcional a su tamaño y se
+        intercala con las transferencias de las demás conexiones.
+
+        Es un generador: se suspende cada vez que la cola de salida supera
+        la marca de agua alta (ver _produce()).
+        """
+        remaining = size
+        while remaining > 0 and self.connect:
+            start = time.perf_counter()
+            chunk = f.read(min(SLICE_CHUNK_SIZE, remaining))
+            self._span("read", start)
+            if not chunk:
+                # El archivo se achicó mientras lo enviábamos: ya no podemos
+                # cumplir con el tamaño anunciado, así que cortamos.
+                logger.warning("Slice truncado para %s", self.peer)
+                self.connect = False
+                break
+            remaining -= len(chunk)
+            if self.protocol == PROTOCOL_V1:
+                start = time.perf_counter()
+                chunk = b64encode(chunk)
+                self._span("encode", start)
+            if self.shaper is not None:
+                start = time.perf_counter()
+                waited = self.shaper.consume(len(chunk))
+                if waited > 0:
+                    self.metrics.inc_counter("hftp_throttled_seconds_total", waited)
+                    self._span("send", start)
+            if self.protocol == PROTOCOL_V2:
+                self._emit(CODE_OK, chunk)
             else:
-                raise ValueError(f"send: codificación inválida '{codificacion}'")
-            # Envía el mensaje
-            while message:
-                bytes_sent = self.socket.send(message)
-                assert bytes_sent > 0
-                message = message[bytes_sent:]
-            self.socket.send(EOL.encode("ascii"))  # Envía el fin de línea
-
-        except BrokenPipeError or ConnectionResetError:
-            logging.warning("No se pudo contactar al cliente")
-            self.connect = False
+                self._write(chunk)
+            if self.output.full():
+                yield
+        if remaining > 0:
+            # Respuesta incompleta: en la versión 2 no se envía el último
+            # frame, para que el cliente no la tome por terminada
+            self.request.pending = None
+            return
+        if self.protocol == PROTOCOL_V1:
+            self._write(EOL.encode("ascii"))
 
     def error_handler(self, cod: int):
         """
@@ -80,11 +445,16 @@ class Connection(object):
         Args:
             cod: Código de respuesta a enviar.
         """
-        if fatal_status(cod):
-            self.send(f"{cod} {error_messages[cod]}")
-            self.quit()
+        self.request.code = cod
+        if self.protocol == PROTOCOL_V2:
+            # En la versión 2 el código va en el frame; los datos de una
+            # respuesta de error son su mensaje
+            self._emit(cod, b"" if cod == CODE_OK
+                       else error_messages[cod].encode("ascii"))
         else:
             self.send(f"{cod} {error_messages[cod]}")
+        if fatal_status(cod):
+            self.quit()
 
     def quit(self):
         """
@@ -92,19 +462,253 @@ class Connection(object):
         """
         self.error_handler(CODE_OK)
         self.connect = False
-        print("Closing connection...")
+        logger.debug("Closing connection to %s", self.peer)
+        try:
+            # Despierta al hilo de la conexión si está esperando otro pedido
+            self.socket.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+    def drain(self):
+        """
+        Pide cerrar la conexión apenas terminen los pedidos en curso, sin
+        atender pedidos nuevos. Se llama desde el hilo del servidor.
+        """
+        self.draining = True
+        try:
+            # Despierta al hilo de la conexión si está esperando otro pedido
+            self.socket.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+    def abort(self):
+        """
+        Corta la conexión aunque haya pedidos en curso.
+        """
+        self.connect = False
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
     def get_file_listing(self):
         """
         Obtiene la lista de archivos disponibles en el directorio y la envía al cliente
+
+        Es un generador, como send_slice_data().
+        """
+        self.error_handler(CODE_OK)
+        # Itero sobre los archivos del directorio sin armar la lista completa,
+        # enviando los nombres de a LISTING_BATCH
+        batch = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                batch.append(entry.name + EOL)
+                if len(batch) == LISTING_BATCH:
+                    self.send_data("".join(batch).encode("ascii"))
+                    batch = []
+                    if self.output.full():
+                        yield
+        # La línea vacía final indica el fin del listado
+        batch.append(EOL)
+        self.send_data("".join(batch).encode("ascii"))
+
+    def list_files(self, cursor: str, limit: int, pattern=None):
+        """
+        Envía una página del listado del directorio.
+
+        La respuesta tiene, después del código, una línea con el cursor para
+        pedir la página siguiente ("0" si no hay más), los nombres de a uno
+        por línea y una línea vacía al final.
+
+        Cada página recorre como mucho MAX_PAGE_SCAN entradas del directorio,
+        así que con un patrón puede traer menos de `limit' nombres, o
+        ninguno, aunque el listado no haya terminado.
+
+        Args:
+            cursor (str): "0" para empezar un listado nuevo, o el cursor
+                devuelto por la página anterior.
+            limit (int): Cantidad máxima de nombres de la página.
+            pattern (str): Patrón glob que deben cumplir los nombres. Solo se
+                tiene en cuenta al empezar un listado.
+        """
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            self.error_handler(INVALID_ARGUMENTS)
+            return
+        if cursor == "0":
+            state = DirectoryCursor(self.directory, pattern)
+            with self.cursors_lock:
+                cursor = str(self.next_cursor)
+                self.next_cursor += 1
+        else:
+            # El listado que sacamos de la tabla es solo de este hilo
+            with self.cursors_lock:
+                state = self.cursors.pop(cursor, None)
+            if state is None:
+                self.error_handler(INVALID_ARGUMENTS)
+                return
+        start = time.perf_counter()
+        names = state.take(limit, MAX_PAGE_SCAN)
+        self._span("read", start)
+        if state.exhausted:
+            cursor = "0"
+        else:
+            with self.cursors_lock:
+                if len(self.cursors) >= MAX_OPEN_CURSORS:
+                    # Descartamos el listado abierto más viejo
+                    oldest = next(iter(self.cursors))
+                    self.cursors.pop(oldest).close()
+                self.cursors[cursor] = state
+        self.error_handler(CODE_OK)
+        names.append(EOL)
+        self.send_data((cursor + EOL + EOL.join(names)).encode("ascii"))
+
+    def close_cursors(self):
+        """
+        Cierra los listados paginados que hayan quedado abiertos.
+        """
+        with self.cursors_lock:
+            for state in self.cursors.values():
+                state.close()
+            self.cursors.clear()
+
+    def set_protocol(self, version: str):
+        """
+        Cambia la versión del protocolo de la conexión. Solo se puede pasar
+        de la versión 1 a la 2; la respuesta al cambio todavía viaja en la
+        versión anterior.
+        """
+        if version == str(PROTOCOL_V2):
+            self.error_handler(CODE_OK)
+            self.protocol = PROTOCOL_V2
+        else:
+            self.error_handler(INVALID_ARGUMENTS)
+
+    def profile(self, args):
+        """
+        Comando de administración del profiling, solo para clientes locales:
+
+            profile start <sample|cprofile> <segundos>
+            profile stop
+            profile spans <on|off>
+
+        start y stop responden con la ruta del archivo del resultado.
+        """
+        host = self.peer.rsplit(":", 1)[0]
+        if not (self.peer == "unix" or host.startswith("127.") or host == "::1"):
+            # Para el resto de los clientes el comando no existe
+            self.error_handler(INVALID_COMMAND)
+            return
+        try:
+            if args[:1] == ["start"] and len(args) == 3:
+                path = self.profiler.start(args[1], float(args[2]))
+            elif args == ["stop"]:
+                path = self.profiler.stop()
+                if path is None:
+                    raise ValueError("no hay una sesión de profiling")
+            elif args[:1] == ["spans"] and len(args) == 2 and args[1] in ("on", "off"):
+                self.profiler.spans = args[1] == "on"
+                path = args[1]
+            else:
+                raise ValueError("argumentos inválidos")
+        except (ValueError, RuntimeError):
+            self.error_handler(INVALID_ARGUMENTS)
+            return
+        self.error_handler(CODE_OK)
+        self.send(path)
+
+    def stats(self):
+        """
+        Envía al cliente las métricas del servidor, una por línea, en el
+        formato de texto de Prometheus, terminadas por una línea vacía.
+        """
+        self.error_handler(CODE_OK)
+        self.send(self.metrics.render(EOL))
+
+    def watch(self):
+        """
+        Suscribe la conexión a los cambios del directorio. Después de la
+        respuesta, cada cambio llega como una línea "<evento> <nombre>",
+        con evento add, modify o delete, hasta el comando unwatch. Si se
+        pierden eventos llega la línea "overflow", y conviene volver a
+        listar el directorio.
+
+        En la versión 1 los eventos se envían solo entre respuestas. En la
+        versión 2 viajan como frames de la respuesta al pedido watch, que
+        termina al pedir unwatch.
+        """
+        if self.watching:
+            self.error_handler(INVALID_COMMAND)
+            return
+        self._open_wakeup()
+        self.events = collections.deque()
+        self.events_lock = threading.Lock()
+        self.watching = True
+        self.watch_id = self.request.id
+        self.watcher.subscribe(self._on_event)
+        self.request.code = CODE_OK
+        if self.protocol == PROTOCOL_V2:
+            # La respuesta queda abierta para los eventos
+            self._write_frame(CODE_OK, FLAG_MORE, b"")
+        else:
+            self.error_handler(CODE_OK)
+
+    def unwatch(self):
         """
-        rta = ""
-        # Itero sobre la lista de archivos disponibles en el directorio
-        for fil in os.listdir(self.directory):
-            # Agrego los archvios a la cadena de respuesta
-            rta += fil + EOL
+        Termina la suscripción a los cambios del directorio, enviando antes
+        los eventos pendientes.
+        """
+        if not self.watching:
+            self.error_handler(INVALID_COMMAND)
+            return
+        self.watcher.unsubscribe(self._on_event)
+        self._send_events()
+        if self.protocol == PROTOCOL_V2:
+            self._write_frame(CODE_OK, 0, b"", self.watch_id)
+        self._stop_watching()
         self.error_handler(CODE_OK)
-        self.send(rta)
+
+    def _stop_watching(self):
+        self.watcher.unsubscribe(self._on_event)
+        self.watching = False
+        with self.events_lock:
+            self.events = None
+            self.events_lost = False
+
+    def _on_event(self, event: str, name: str):
+        """
+        Recibe un evento del watcher, desde su hilo: lo encola y despierta
+        al hilo de la conexión, que es quien lo envía.
+        """
+        if set(name) - VALID_CHARS:
+            # No se podría pedir con ningún comando
+            return
+        with self.events_lock:
+            if self.events is None:
+                # La suscripción ya terminó
+                return
+            if len(self.events) >= MAX_WATCH_EVENTS:
+                self.events_lost = True
+                return
+            self.events.append(f"{event} {name}")
+        self._wake()
+
+    def _send_events(self):
+        """
+        Envía al cliente los eventos pendientes.
+        """
+        with self.events_lock:
+            events = list(self.events)
+            self.events.clear()
+            if self.events_lost:
+                events.append("overflow")
+                self.events_lost = False
+        for event in events:
+            if self.protocol == PROTOCOL_V2:
+                self._write_frame(CODE_OK, FLAG_MORE, event.encode("ascii"),
+                                  self.watch_id)
+            else:
+                self._write((event + EOL).encode("ascii"))
 
     def get_metadata(self, filename):
         """
@@ -114,7 +718,9 @@ class Connection(object):
         code_res = self.valid_file(filename)
         # Buscamos si el archivo se encuentra en el directorio y que sus caracteres sean validos
         if code_res == CODE_OK:
+            start = time.perf_counter()
             file_size = os.path.getsize(os.path.join(self.directory, filename))
+            self._span("read", start)
             self.error_handler(CODE_OK)
             # Añade un carácter de fin de línea
             self.send(f"{file_size}\n")
@@ -124,18 +730,45 @@ class Connection(object):
         else:
             self.error_handler(FILE_NOT_FOUND)
 
+    def get_identity(self, filename: str):
+        """
+        Envía la identidad del archivo: su tamaño y su fecha de modificación
+        en nanosegundos, separados por un espacio. Si ninguno de los dos
+        cambió, el cliente puede dar por buena la copia que ya tiene.
+        """
+        code_res = self.valid_file(filename)
+        if code_res != CODE_OK:
+            self.error_handler(code_res)
+            return
+        start = time.perf_counter()
+        st = os.stat(os.path.join(self.directory, filename))
+        self._span("read", start)
+        self.error_handler(CODE_OK)
+        self.send(f"{st.st_size} {st.st_mtime_ns}")
+
     def get_slice(self, filename: str, offset: int, size: int):
         """
         Args:
             filename (str): El nombre del archivo del que se va a obtener el slice.
             offset (int): El byte de inicio del slice.
             size (int): El tamaño del slice.
+
+        Returns:
+            Si el pedido es válido, el generador que envía el slice (ver
+            _produce()); si no, None.
         """
         code_res = self.valid_file(filename)
+        if code_res == CODE_OK:
+            # El nombre tiene que coincidir exactamente, aun en sistemas de
+            # archivos que no distinguen mayúsculas
+            start = time.perf_counter()
+            if filename not in os.listdir(self.directory):
+                code_res = FILE_NOT_FOUND
+            self._span("validate", start)
         if code_res != CODE_OK:
             # Si el archivo no es valido, enviamos el codigo correspondiente
             self.error_handler(code_res)
-        elif filename in os.listdir(self.directory):
+        else:
             filepath = os.path.join(self.directory, filename)
             file_size = os.path.getsize(filepath)
             if offset < 0 or offset + size > file_size:
@@ -143,28 +776,61 @@ class Connection(object):
             elif size < 0:
                 self.error_handler(INVALID_ARGUMENTS)
             else:
-                # Con "rb" abrimos el archivo en modo lectura binario
-                # Usamos with para garantizar la adquisicion y liberacion adecuada de recursos
-                with open(filepath, "rb") as f:
-                    # Lee el slice del archivo especificado, inicia en offset y lee size bytes
-                    f.seek(offset)
-                    slice_data = f.read(size)
-                    self.error_handler(CODE_OK)
-                    self.send(slice_data, "b64encode")
-        else:
-            self.error_handler(FILE_NOT_FOUND)
+                return self._slice(filepath, offset, size)
+
+    def _slice(self, filepath: str, offset: int, size: int):
+        # Con "rb" abrimos el archivo en modo lectura binario
+        # Usamos with para garantizar la adquisicion y liberacion adecuada de recursos
+        with open(filepath, "rb") as f:
+            # Envía el slice del archivo especificado, inicia en offset y lee size bytes
+            f.seek(offset)
+            self.error_handler(CODE_OK)
+            yield from self.send_slice_data(f, size)
 
     # Creo un selector de comandos, que se encargará de llamar a los métodos correspondientes
     # cmd es un string que representa el comando a ejecutar
-    def cmd_selector(self, input):
+    def cmd_selector(self, input, request_id=0, suspend=False):
         """
         Selecciona el comando a ejecutar segun el string cmd
+
+        Si `suspend', una respuesta larga se suspende cuando la cola de
+        salida supera la marca de agua alta (ver _produce()).
+
+        Returns:
+            False si la respuesta quedó suspendida, True si terminó.
         """
         # Debo trabajar el input para separar el comando de los argumentos
+        start = time.perf_counter()
+        cmd = None
+        request = self.request
+        request.id = request_id
+        # Si el comando no llega a responder nada, cuenta como error interno
+        request.code = INTERNAL_ERROR
+        request.nbytes = 0
+        request.spans = {} if self.profiler.spans else None
+        logger.debug("Received from %s: %r", self.peer, input)
+        cmd, *args = input.split(" ")
+        self._span("parse", start)
+        # El comando profile no se perfila: profile stop esperaría a que
+        # termine él mismo. Si no se puede perfilar, se atiende igual.
+        profile = None
+        if cmd != "profile":
+            profile = self.profiler.begin_request()
+        job = Job(cmd, args[0] if args else None, start)
+        try:
+            self._run(job, args)
+            # Si la respuesta se suspende, lo que falta no se perfila
+            return self._produce(job, suspend)
+        finally:
+            self.profiler.end_request(profile)
+
+    def _run(self, job, args):
+        """
+        Ejecuta el comando del pedido `job' con los argumentos `args'. Los
+        que producen una respuesta larga dejan en `job' su generador.
+        """
+        cmd = job.cmd
         try:
-            print("Received: %s" % input)
-            cmd, *args = input.split(" ")
-            print(f"Command: {cmd}")
             if cmd == "quit":
                 if len(args) == 0:
                     self.quit()
@@ -175,73 +841,407 @@ class Connection(object):
                     self.get_metadata(args[0])
                 else:
                     self.error_handler(INVALID_ARGUMENTS)
+            elif cmd == "get_identity":
+                if len(args) == 1:
+                    self.get_identity(args[0])
+                else:
+                    self.error_handler(INVALID_ARGUMENTS)
             elif cmd == "get_slice":
                 if len(args) == 3:
                     try:
                         offset = int(args[1])
                         size = int(args[2])
-                        self.get_slice(args[0], offset, size)
+                        job.producer = self.get_slice(args[0], offset, size)
                     except:
                         self.error_handler(INVALID_ARGUMENTS)
                 else:
                     self.error_handler(INVALID_ARGUMENTS)
             elif cmd == "get_file_listing":
                 if len(args) == 0:
-                    self.get_file_listing()
+                    job.producer = self.get_file_listing()
+                else:
+                    self.error_handler(INVALID_ARGUMENTS)
+            elif cmd == "list_files":
+                if len(args) in (2, 3):
+                    try:
+                        limit = int(args[1])
+                    except ValueError:
+                        self.error_handler(INVALID_ARGUMENTS)
+                    else:
+                        self.list_files(args[0], limit, *args[2:])
+                else:
+                    self.error_handler(INVALID_ARGUMENTS)
+            elif cmd == "protocol":
+                if len(args) == 1:
+                    self.set_protocol(args[0])
+                else:
+                    self.error_handler(INVALID_ARGUMENTS)
+            elif cmd in ("watch", "unwatch"):
+                if len(args) == 0:
+                    getattr(self, cmd)()
+                else:
+                    self.error_handler(INVALID_ARGUMENTS)
+            elif cmd == "profile":
+                self.profile(args)
+            elif cmd == "stats":
+                if len(args) == 0:
+                    self.stats()
                 else:
                     self.error_handler(INVALID_ARGUMENTS)
             else:
                 self.error_handler(INVALID_COMMAND)
-        except Exception as e:
-            print(f"Error in connection handling: {e}")
+        except Exception:
+            logger.exception("Error in connection handling")
+
+    def _produce(self, job, suspend):
+        """
+        Produce la respuesta del pedido `job' y lo termina.
+
+        Cada vez que la cola de salida supera la marca de agua alta, si
+        `suspend' (en los hilos de los pools) la respuesta se suspende: el
+        hilo queda libre y el de la conexión la reanuda con resume() cuando
+        la cola baja de la marca baja. Si no (en el hilo de la conexión),
+        vacía la cola hasta la marca baja y sigue.
+
+        Returns:
+            False si la respuesta quedó suspendida, True si terminó.
+        """
+        request = self.request
+        try:
+            for _ in job.producer or ():
+                self.metrics.inc_counter("hftp_output_stalls_total")
+                if suspend:
+                    job.state = (request.id, request.code, request.pending,
+                                 request.nbytes, request.spans)
+                    # El próximo pedido de este hilo no puede heredar el
+                    # frame retenido
+                    request.pending = None
+                    with self.output_lock:
+                        if self.suspended is None:
+                            self.suspended = collections.deque()
+                        self.suspended.append(job)
+                    self._wake()
+                    return False
+                start = time.perf_counter()
+                with self.output_lock:
+                    self._drain(self.output.low)
+                self._span("send", start)
+        except Exception:
+            logger.exception("Error in connection handling")
+        self._finish(job)
+        return True
+
+    def resume(self, job):
+        """
+        Reanuda en un hilo de los pools una respuesta suspendida.
+        """
+        done = True
+        request = self.request
+        (request.id, request.code, request.pending, request.nbytes,
+         request.spans) = job.state
+        job.state = None
+        try:
+            done = self._produce(job, True)
+        finally:
+            if done:
+                self._request_done()
+
+    def _finish(self, job):
+        """
+        Termina la respuesta del pedido `job' y lo registra.
+        """
+        request = self.request
+        self.end_response()
+        elapsed = time.perf_counter() - job.start
+        self.metrics.observe_command(job.cmd, request.code, elapsed)
+        if request.spans:
+            self.metrics.observe_spans(job.cmd, request.spans)
+        access_log(self.peer, job.cmd, job.arg, request.code, request.nbytes,
+                   elapsed)
+
+    def dispatch(self, line, request_id=0):
+        """
+        Atiende un pedido. Si la conexión tiene pools de ejecución, lo
+        ejecuta en el que corresponde a su clase: en la versión 1 espera a
+        que termine, porque las respuestas deben salir en orden; en la
+        versión 2 vuelve enseguida a leer el pedido siguiente. Mientras
+        espera, envía las respuestas que producen los pools.
+        """
+        kind = command_class(line.split(" ", 1)[0])
+        if self.executors is None or kind == INLINE:
+            self.cmd_selector(line, request_id)
+            return
+        ordered = self.protocol == PROTOCOL_V1
+        self._open_wakeup()
+        self._wait_requests(MAX_INFLIGHT)
+        with self.inflight_lock:
+            self.inflight += 1
+        try:
+            self.executors.submit(kind, self.run_command, line, request_id)
+        except BaseException:
+            self._request_done()
+            raise
+        if ordered:
+            self._wait_requests()
+
+    def run_command(self, line, request_id):
+        """
+        Ejecuta un pedido en un hilo de los pools. Su respuesta la envía el
+        hilo de la conexión.
+        """
+        done = True
+        try:
+            done = self.cmd_selector(line, request_id, True)
+        finally:
+            if done:
+                self._request_done()
+
+    def _request_done(self):
+        with self.inflight_lock:
+            self.inflight -= 1
+            if not self.inflight:
+                self.idle_since = time.monotonic()
+        self._wake()
+
+    def _wait_requests(self, limit=1):
+        """
+        Espera a que haya menos de `limit' pedidos en ejecución en los
+        pools, enviando mientras tanto sus respuestas.
+        """
+        while self.inflight >= limit:
+            self._pump(None)
+
+    def _pump(self, timeout, read=False):
+        """
+        Espera hasta `timeout' segundos (None: sin límite) a que el socket
+        acepte datos de la cola de salida, a que lo despierten los otros
+        hilos o, si `read', a que lleguen datos del cliente. Después envía
+        lo que el socket acepte sin bloquearse y reanuda en los pools las
+        respuestas suspendidas si la cola bajó de la marca de agua baja.
+
+        Returns:
+            False si pasaron `timeout' segundos sin novedades.
+        """
+        write = self.writable and self.output.size > 0
+        if write and self.send_timeout is not None:
+            left = self.send_since + self.send_timeout - time.monotonic()
+            left = max(left, 0.001)
+            timeout = left if timeout is None else min(timeout, left)
+        wakeup = self.wakeup[0] if self.wakeup is not None else None
+        ready = poll_socket(self.socket, read, write, timeout, wakeup)
+        if wakeup is not None:
+            try:
+                # Descartamos los avisos: lo que anuncian se revisa a continuación
+                wakeup.recv(4096)
+            except BlockingIOError:
+                pass
+        jobs = None
+        with self.output_lock:
+            if self.writable and self.output.size:
+                self._send(ready)
+            if self.suspended and self.output.size <= self.output.low:
+                jobs, self.suspended = self.suspended, None
+        for job in jobs or ():
+            self.executors.submit(command_class(job.cmd), self.resume, job)
+        return ready
+
+    def _read_timeout(self):
+        """
+        Devuelve cuánto puede bloquearse el próximo recv: lo que le queda
+        del idle timeout, acotado por lo que le queda al pedido en curso
+        para completarse.
+        """
+        # Una conexión suscripta a los cambios está ociosa a propósito
+        timeout = None if self.watching else self.idle_timeout
+        if timeout is not None and not self.inflight and not self.output.size:
+            left = self.idle_since + timeout - time.monotonic()
+            timeout = max(left, 0.001)
+        if self.request_started is not None and self.request_timeout is not None:
+            left = self.request_started + self.request_timeout - time.monotonic()
+            left = max(left, 0.001)
+            timeout = left if timeout is None else min(timeout, left)
+        return timeout
+
+    def reclaim(self, reason: str):
+        """
+        Cierra una conexión que no progresa y lo registra en las métricas.
+        """
+        logger.info("Reclaiming connection to %s (%s)", self.peer, reason)
+        self.metrics.inc_counter(
+            'hftp_connections_reclaimed_total{reason="%s"}' % reason)
+        self.connect = False
 
     def _recv(self):
         """
-        Recibe datos y acumula en el buffer interno.
+        Recibe datos y acumula en el buffer interno. Mientras espera al
+        cliente le envía la cola de salida (ver _pump()). Con la cola sobre
+        la marca de agua alta no lee pedidos nuevos hasta que el cliente
+        lea las respuestas.
 
         Para uso privado del servidor.
         """
+        # Mientras atendíamos el pedido anterior el cliente no podía
+        # completar el siguiente: su plazo corre desde ahora
+        if self.request_started is None and self.buffer:
+            self.request_started = time.monotonic()
+        read = not self.output.full()
         try:
-            data = self.socket.recv(4096)
-            data_byte = data.decode("ascii")
-            self.buffer += data_byte
+            if not self._pump(self._read_timeout(), read) or not read:
+                self._check_timeouts()
+                return
+            # Leemos en un buffer prestado y copiamos solo lo recibido
+            chunk = read_buffers.acquire()
+            try:
+                n = self.socket.recv_into(chunk)
+                if self.buffer:
+                    self.buffer += memoryview(chunk)[:n]
+                elif n:
+                    self.buffer = bytearray(memoryview(chunk)[:n])
+            finally:
+                read_buffers.release(chunk)
+            self.metrics.add_bytes_in(n)
+            self.idle_since = time.monotonic()
+            if self.request_started is None and self.buffer:
+                self.request_started = time.monotonic()
             # Buscamos errores
-            if len(data_byte) == 0:
-                self.quit()
-            if len(self.buffer) >= 2**32:
+            if n == 0 and self.connect and not self.draining:
+                if self.protocol == PROTOCOL_V2:
+                    # No hay ningún pedido al que responder: solo cerramos
+                    logger.debug("Closing connection to %s", self.peer)
+                    self.connect = False
+                else:
+                    self.quit()
+            # En la versión 2 el tamaño de cada frame se controla al decodificarlo
+            if self.protocol == PROTOCOL_V1 and len(self.buffer) >= MAX_LINE_SIZE:
                 self.error_handler(BAD_REQUEST)
-        except UnicodeError:
-            self.error_handler(BAD_REQUEST)
-        except ConnectionResetError or BrokenPipeError:
-            logging.warning("No se pudo contactar al cliente")
+        except BlockingIOError:
+            # Falsa alarma de poll_socket(), o nos despertaron otros hilos
+            self._check_timeouts()
+        except (ConnectionResetError, BrokenPipeError):
+            logger.warning("No se pudo contactar al cliente %s", self.peer)
             self.connect = False
 
+    def _check_timeouts(self):
+        """
+        Libera la conexión si el pedido a medio recibir o la espera al
+        cliente superaron sus plazos.
+        """
+        now = time.monotonic()
+        if self.request_started is not None and self.request_timeout is not None \
+                and now - self.request_started >= self.request_timeout:
+            # Un pedido que llega de a gotas (slowloris)
+            self.reclaim("request_timeout")
+        elif self.idle_timeout is None or self.watching or self.inflight \
+                or self.output.size or now - self.idle_since < self.idle_timeout:
+            # En la versión 2 el hilo espera al cliente mientras los pools
+            # atienden sus pedidos, y mientras se le envían las respuestas:
+            # eso no es estar ocioso
+            pass
+        else:
+            self.reclaim("idle")
+
     def parser(self):
         """
-        Espera datos hasta obtener una línea completa delimitada por el
-        terminador del protocolo.
+        Espera datos hasta obtener un pedido completo: una línea delimitada
+        por el terminador del protocolo o, en la versión 2, un frame.
 
-        Devuelve la línea sin el terminador ni espacios en blanco al inicio o final.
+        Devuelve el pedido sin el terminador ni espacios en blanco al inicio
+        o final, o None si la conexión terminó.
         """
-        # Mientras que no termine la linea del buffer y permanezcamos conectados;
-        while not EOL in self.buffer and self.connect:
+        # Mientras permanezcamos conectados
+        while self.connect and not self.draining:
+            if self.output.full():
+                # El cliente no lee las respuestas: no atendemos los pedidos
+                # que ya están en el buffer hasta que la cola baje
+                self._recv()
+                continue
+            try:
+                if self.protocol == PROTOCOL_V2:
+                    line = self._parse_frame()
+                else:
+                    line = self._parse_line()
+            except UnicodeError:
+                self.error_handler(BAD_REQUEST)
+                return None
+            if line is not None:
+                # El plazo de un pedido encolado detrás de este corre recién
+                # cuando se vuelva a esperar al cliente (ver _recv())
+                self.request_started = None
+                return line
+            if not self.connect:
+                break
+            if self.watching:
+                self._send_events()
+            # Los pedidos ya encolados en el buffer se atienden sin vaciar la
+            # cola mientras esta no supere la marca de agua alta; lo pendiente
+            # se envía mientras esperamos al cliente
             self._recv()
-        if EOL in self.buffer:
-            # Si encontramos el fin de linea debemos "splitear" el buffer
-            respuesta, self.buffer = self.buffer.split(EOL, 1)
-            return respuesta.strip()
+        return None
+
+    def _parse_line(self):
+        """
+        Extrae del buffer una línea completa, o devuelve None si todavía
+        no llegó. El fin de línea se busca solo en los bytes nuevos.
+        """
+        pos = self.buffer.find(EOL.encode("ascii"), self.scanned)
+        if pos < 0:
+            # El terminador podría quedar partido entre dos recv
+            self.scanned = max(len(self.buffer) - len(EOL) + 1, 0)
+            return None
+        # Si encontramos el fin de linea debemos "splitear" el buffer
+        respuesta = bytes(self.buffer[:pos])
+        del self.buffer[:pos + len(EOL)]
+        if not self.buffer:
+            self.buffer = b""
+        self.scanned = 0
+        return respuesta.decode("ascii").strip()
+
+    def _parse_frame(self):
+        """
+        Extrae del buffer un frame de pedido completo, o devuelve None si
+        todavía no llegó. Deja en self.request.id el id del pedido.
+        """
+        try:
+            frame = decode_request(self.buffer, MAX_LINE_SIZE)
+        except ValueError:
+            self.request.id = 0
+            self.error_handler(BAD_REQUEST)
+            return None
+        if frame is None:
+            return None
+        if not self.buffer:
+            self.buffer = b""
+        self.request.id, payload = frame
+        return payload.decode("ascii").strip()
 
     def handle(self):
         """
         Atiende eventos de la conexión hasta que termina.
         """
         line = ""
-        while self.connect:
-            if NEWLINE in line:
+        # Al drenar no se atienden más pedidos, pero los de la versión 2 en
+        # ejecución terminan de enviarse: connect sigue en True
+        while self.connect and not self.draining:
+            if self.protocol == PROTOCOL_V1 and NEWLINE in line:
                 # En caso de que no haya nada en el archivo deberia haber /r/n, no /n.
                 self.error_handler(BAD_EOL)
-            elif len(line) > 0:
-                self.cmd_selector(line)
+            elif len(line) > 0 or self.protocol == PROTOCOL_V2:
+                # En la versión 2 un frame sin comando también lleva su
+                # respuesta (NO SUCH COMMAND), o su id quedaría sin contestar
+                self.dispatch(line, self.request.id)
+                # Mientras se atendía el pedido la conexión no estaba ociosa
+                self.idle_since = time.monotonic()
             # Seguimos buscando lineas hasta que en recv, llamado por parser, setea self.connect en false.
             line = self.parser()
+        # Enviamos lo que haya quedado pendiente, por ejemplo la respuesta a quit
+        self._wait_requests()
+        self.end_response()
+        self.flush()
+        self.close_cursors()
+        if self.watching:
+            self._stop_watching()
+        if self.wakeup is not None:
+            for s in self.wakeup:
+                s.close()
+            self.wakeup = None
         self.socket.close()
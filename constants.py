@@ -8,7 +8,34 @@
 DEFAULT_DIR = "testdata"
 DEFAULT_ADDR = "0.0.0.0"  # 0.0.0.0 representa todas las IPv4 del server
 DEFAULT_PORT = 19500
+DEFAULT_METRICS_ADDR = "127.0.0.1"  # El endpoint de métricas es local
 MAX_BUFFER_SIZE = 2**32
+DEFAULT_IDLE_TIMEOUT = 300  # Segundos sin recibir nada antes de cerrar
+DEFAULT_REQUEST_TIMEOUT = 30  # Segundos para completar una línea de pedido
+DEFAULT_SEND_TIMEOUT = 60  # Segundos bloqueado enviando antes de cerrar
+DEFAULT_HIGH_WATERMARK = 2**18  # Bytes en la cola de salida para dejar de producir
+DEFAULT_LOW_WATERMARK = 2**16  # Bytes en la cola de salida para volver a producir
+MAX_LINE_SIZE = 2**16  # Longitud máxima de una línea de pedido
+LISTING_BATCH = 256  # Nombres enviados por vez en get_file_listing
+MAX_PAGE_SIZE = 10000  # Nombres por página como máximo en list_files
+MAX_PAGE_SCAN = 2 * MAX_PAGE_SIZE  # Entradas recorridas por página de list_files
+DEFAULT_PAGE_SIZE = 1000  # Nombres por página que pide el cliente
+MAX_OPEN_CURSORS = 8  # Listados paginados abiertos por conexión
+DEFAULT_FAST_WORKERS = 8  # Hilos para comandos de control y metadatos
+DEFAULT_BULK_WORKERS = 16  # Hilos para transferencias de datos
+DEFAULT_BULK_QUEUE = 64  # Transferencias que esperan un hilo libre
+READ_BUFFER_SIZE = 2**14  # Bytes leídos del socket por vez
+MAX_FREE_BUFFERS = 64  # Buffers de lectura libres que se guardan para reusar
+MIN_THREAD_STACK_SIZE = 2**15  # Pila mínima que acepta threading.stack_size
+DEFAULT_PROFILE_SECONDS = 30  # Duración del profiling lanzado con SIGUSR1
+MAX_INFLIGHT = 32  # Pedidos de la versión 2 en ejecución por conexión
+DEFAULT_CACHE_SIZE = 2**30  # Bytes que ocupa como mucho la caché del cliente
+DEFAULT_WATCH_INTERVAL = 1.0  # Segundos entre snapshots del directorio sin inotify
+MAX_WATCH_EVENTS = 1024  # Eventos de watch pendientes de enviar por conexión
+DEFAULT_DRAIN_TIMEOUT = 60  # Segundos para terminar los pedidos en curso al recargar
+RELOAD_TIMEOUT = 30  # Segundos que se espera a que arranque el proceso nuevo
+ACCEPT_BACKOFF = 0.1  # Segundos sin aceptar conexiones si faltan recursos
+SLICE_CHUNK_SIZE = 3 * 2**14  # Bytes leídos por vez al enviar un slice
 
 EOL = "\r\n"
 NEWLINE = "\n"
@@ -16,6 +43,7 @@ NEWLINE = "\n"
 CODE_OK = 0
 BAD_EOL = 100
 BAD_REQUEST = 101
+SERVER_BUSY = 102
 INTERNAL_ERROR = 199
 INVALID_COMMAND = 200
 INVALID_ARGUMENTS = 201
@@ -28,6 +56,7 @@ error_messages = {
     # 1xx: Errores fatales (no se pueden atender más pedidos)
     BAD_EOL: "BAD EOL",
     BAD_REQUEST: "BAD REQUEST",
+    SERVER_BUSY: "TOO MANY CONNECTIONS",
     INTERNAL_ERROR: "INTERNAL SERVER ERROR",
     # 2xx: Errores no fatales (no se pudo atender este pedido)
     INVALID_COMMAND: "NO SUCH COMMAND",
@@ -0,0 +1,102 @@
+# encoding: utf-8
+# Ejecución de los comandos del servidor HFTP en dos pools de hilos
+# separados según su costo.
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Clases de comandos:
+# FAST: control y metadatos, de costo acotado (quit, get_metadata, stats...)
+# BULK: entrada/salida de volumen arbitrario (slices, listado completo)
+# INLINE: cambian el estado que usa el hilo de la conexión al esperar
+#     pedidos, así que se ejecutan en ese mismo hilo
+FAST = "fast"
+BULK = "bulk"
+INLINE = "inline"
+
+BULK_COMMANDS = frozenset(("get_slice", "get_file_listing"))
+INLINE_COMMANDS = frozenset(("watch", "unwatch"))
+
+
+def command_class(cmd):
+    """
+    Devuelve la clase (FAST, BULK o INLINE) del comando `cmd'.
+    """
+    if cmd in INLINE_COMMANDS:
+        return INLINE
+    return BULK if cmd in BULK_COMMANDS else FAST
+
+
+class CommandExecutors(object):
+    """
+    Un pool de hilos de baja latencia para los comandos baratos y otro,
+    acotado, para las transferencias. Cuando el pool de transferencias está
+    saturado sus pedidos esperan en cola (y, pasado el límite de la cola,
+    quien los envía se bloquea), sin demorar a los comandos baratos.
+
+    La cantidad de pedidos en cola y en ejecución de cada clase se exporta
+    en las métricas.
+    """
+
+    def __init__(self, metrics, fast_workers, bulk_workers, bulk_queue):
+        """
+        Args:
+            metrics (Metrics): Registro donde exportar el estado de las colas.
+            fast_workers (int): Hilos para los comandos baratos.
+            bulk_workers (int): Hilos para las transferencias.
+            bulk_queue (int): Transferencias que pueden esperar en cola a
+                que se libere un hilo.
+        """
+        self.metrics = metrics
+        self.pools = {
+            FAST: ThreadPoolExecutor(fast_workers, thread_name_prefix="hftp-fast"),
+            BULK: ThreadPoolExecutor(bulk_workers, thread_name_prefix="hftp-bulk"),
+        }
+        self.bulk_slots = threading.BoundedSemaphore(bulk_workers + bulk_queue)
+        self.lock = threading.Lock()
+        self.queued = {FAST: 0, BULK: 0}
+        self.running = {FAST: 0, BULK: 0}
+        for kind in (FAST, BULK):
+            self._export(kind)
+
+    def submit(self, kind, fn, *args):
+        """
+        Encola la ejecución de fn(*args) en el pool de la clase `kind'.
+        Si la cola de transferencias está llena, espera a que haya lugar.
+
+        Returns:
+            El Future de la ejecución.
+        """
+        if kind == BULK:
+            self.bulk_slots.acquire()
+        with self.lock:
+            self.queued[kind] += 1
+            self._export(kind)
+        return self.pools[kind].submit(self._run, kind, fn, args)
+
+    def _run(self, kind, fn, args):
+        with self.lock:
+            self.queued[kind] -= 1
+            self.running[kind] += 1
+            self._export(kind)
+        try:
+            return fn(*args)
+        finally:
+            with self.lock:
+                self.running[kind] -= 1
+                self._export(kind)
+            if kind == BULK:
+                self.bulk_slots.release()
+
+    def _export(self, kind):
+        """
+        Actualiza los gauges de la clase `kind'. Se llama con el lock tomado.
+        """
+        self.metrics.set_gauge('hftp_executor_queued{class="%s"}' % kind,
+                               self.queued[kind])
+        self.metrics.set_gauge('hftp_executor_running{class="%s"}' % kind,
+                               self.running[kind])
+
+    def shutdown(self, wait=True):
+        for pool in self.pools.values():
+            pool.shutdown(wait)
@@ -0,0 +1,95 @@
+# encoding: utf-8
+# Framing binario de la versión 2 del protocolo HFTP.
+#
+# Una conexión empieza hablando el protocolo de líneas de siempre. Si el
+# cliente envía "protocol 2" y el server responde "0 OK", a partir de ahí
+# todo viaja en frames con prefijo de longitud:
+#
+#   pedido:    | longitud (4) | id (4) | comando en ascii (longitud bytes) |
+#   respuesta: | longitud (4) | id (4) | código (2) | flags (1) | datos |
+#
+# Los enteros van en network byte order. Cada respuesta lleva el id del
+# pedido al que contesta, así que pueden llegar en otro orden. Una
+# respuesta puede ocupar varios frames: todos menos el último llevan
+# FLAG_MORE. El código de la respuesta es el del primer frame y sus datos
+# son la concatenación de los datos de todos sus frames; los datos viajan
+# crudos, sin base64. En las respuestas de error los datos son el mensaje.
+
+import struct
+
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+
+REQUEST_HEADER = struct.Struct("!II")
+RESPONSE_HEADER = struct.Struct("!IIHB")
+
+# Hay más frames para la misma respuesta
+FLAG_MORE = 0x01
+
+
+def encode_request(request_id: int, command: str) -> bytes:
+    """
+    Devuelve el frame de un pedido con el comando `command'.
+    """
+    payload = command.encode("ascii")
+    return REQUEST_HEADER.pack(len(payload), request_id) + payload
+
+
+def encode_response_header(request_id: int, code: int, flags: int,
+                           length: int) -> bytes:
+    """
+    Devuelve el encabezado de un frame de respuesta con `length' bytes de
+    datos, que se envían a continuación.
+    """
+    return RESPONSE_HEADER.pack(length, request_id, code, flags)
+
+
+def decode_request(buffer, max_size):
+    """
+    Extrae un frame de pedido del principio de `buffer' (un bytearray),
+    consumiéndolo.
+
+    Returns:
+        Un par (id, comando en bytes), o None si el frame todavía no llegó
+        completo.
+
+    Raises:
+        ValueError: Si el frame declara más de `max_size' bytes.
+    """
+    if len(buffer) < REQUEST_HEADER.size:
+        return None
+    length, request_id = REQUEST_HEADER.unpack_from(buffer)
+    if length > max_size:
+        raise ValueError("frame demasiado grande: %d bytes" % length)
+    end = REQUEST_HEADER.size + length
+    if len(buffer) < end:
+        return None
+    payload = bytes(buffer[REQUEST_HEADER.size:end])
+    # Borrar del principio de un bytearray es O(1) en CPython
+    del buffer[:end]
+    return request_id, payload
+
+
+def decode_response(buffer, max_size):
+    """
+    Extrae un frame de respuesta del principio de `buffer' (un bytearray),
+    consumiéndolo.
+
+    Returns:
+        Una tupla (id, código, flags, datos), o None si el frame todavía no
+        llegó completo.
+
+    Raises:
+        ValueError: Si el frame declara más de `max_size' bytes.
+    """
+    if len(buffer) < RESPONSE_HEADER.size:
+        return None
+    length, request_id, code, flags = RESPONSE_HEADER.unpack_from(buffer)
+    if length > max_size:
+        raise ValueError("frame demasiado grande: %d bytes" % length)
+    end = RESPONSE_HEADER.size + length
+    if len(buffer) < end:
+        return None
+    payload = bytes(buffer[RESPONSE_HEADER.size:end])
+    del buffer[:end]
+    return request_id, code, flags, payload
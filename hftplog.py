@@ -0,0 +1,171 @@
+# encoding: utf-8
+# Logging del servidor HFTP: los registros se encolan desde los hilos que
+# atienden conexiones y un único hilo de fondo (QueueListener) los escribe,
+# de modo que una terminal o un pipe lento no frena a los pedidos.
+
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+from constants import CODE_OK
+
+# Cantidad máxima de registros pendientes de escribir. Si el escritor no da
+# abasto se descartan registros en lugar de bloquear a los hilos.
+LOG_QUEUE_SIZE = 10000
+
+LOG_LEVELS = {'DEBUG': logging.DEBUG,
+              'INFO': logging.INFO,
+              'WARN': logging.WARNING,
+              'ERROR': logging.ERROR,
+              }
+
+# Campos extra que se agregan a los registros del access log
+ACCESS_FIELDS = ("peer", "command", "file", "code", "bytes", "duration")
+
+access_logger = logging.getLogger("hftp.access")
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler que nunca bloquea: si la cola está llena descarta el
+    registro y lo cuenta en `dropped' y, si se le dio un registro de
+    métricas, en hftp_log_dropped_total.
+    """
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+        self.metrics = None
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            if self.metrics is not None:
+                self.metrics.inc_counter("hftp_log_dropped_total")
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formatea cada registro como un objeto JSON en una línea.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in ACCESS_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class AccessSampler(object):
+    """
+    Decide qué pedidos se registran en el access log.
+
+    `rates' asocia un comando a N: se registra uno de cada N pedidos
+    exitosos de ese comando. Los errores se registran siempre.
+    """
+
+    def __init__(self, rates=None):
+        self.rates = dict(rates or {})
+        self.counters = {cmd: itertools.count() for cmd in self.rates}
+
+    def sample(self, cmd, code):
+        n = self.rates.get(cmd, 1)
+        if n <= 1 or code != CODE_OK:
+            return True
+        # next() sobre itertools.count es atómico bajo el GIL
+        return next(self.counters[cmd]) % n == 0
+
+
+_sampler = AccessSampler()
+
+
+def parse_sample_rates(spec):
+    """
+    Convierte una especificación "cmd=N,cmd2=M" en un diccionario.
+
+    Raises:
+        ValueError: Si la especificación está mal formada.
+    """
+    rates = {}
+    if spec:
+        for item in spec.split(","):
+            cmd, n = item.split("=", 1)
+            rates[cmd.strip()] = int(n)
+    return rates
+
+
+def setup_logging(level=logging.INFO, json_format=False, sample_rates=None,
+                  stream=None):
+    """
+    Configura el logger raíz para escribir a través de una cola.
+
+    Args:
+        level (int): Nivel mínimo de los registros.
+        json_format (bool): Si es True cada registro se escribe como JSON.
+        sample_rates (dict): Muestreo del access log, ver AccessSampler.
+        stream: Archivo donde escribir. Por defecto sys.stderr.
+
+    Returns:
+        El QueueListener lanzado; hay que llamar a stop() al terminar para
+        vaciar la cola.
+    """
+    global _sampler
+    _sampler = AccessSampler(sample_rates)
+
+    target = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    if json_format:
+        target.setFormatter(JsonFormatter())
+    else:
+        target.setFormatter(logging.Formatter(
+            "%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    q = queue.Queue(LOG_QUEUE_SIZE)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(DroppingQueueHandler(q))
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(q, target)
+    listener.start()
+    return listener
+
+
+def export_dropped(metrics):
+    """
+    Exporta en `metrics' la cantidad de registros descartados por la cola
+    de logging que instaló setup_logging(), incluidos los ya descartados.
+    """
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, DroppingQueueHandler):
+            metrics.inc_counter("hftp_log_dropped_total", handler.dropped)
+            handler.metrics = metrics
+
+
+def access_log(peer, cmd, filename, code, nbytes, elapsed):
+    """
+    Registra un pedido atendido en el access log, respetando el nivel y
+    el muestreo configurados. Si no corresponde registrarlo no se llega a
+    construir el registro.
+    """
+    if not access_logger.isEnabledFor(logging.INFO):
+        return
+    if not _sampler.sample(cmd, code):
+        return
+    access_logger.info(
+        "%s %s %s %d %dB %.6fs", peer, cmd, filename or "-", code, nbytes,
+        elapsed,
+        extra={"peer": peer, "command": cmd, "file": filename, "code": code,
+               "bytes": nbytes, "duration": elapsed})
@@ -0,0 +1,69 @@
+# encoding: utf-8
+# Listado paginado del directorio compartido del servidor HFTP.
+
+import fnmatch
+import os
+
+
+class DirectoryCursor(object):
+    """
+    Recorre un directorio con os.scandir de a páginas, sin armar nunca la
+    lista completa de nombres. Opcionalmente filtra los nombres con un
+    patrón estilo glob (por ejemplo "log_*" o "*.txt").
+    """
+
+    def __init__(self, directory, pattern=None):
+        self.iterator = os.scandir(directory)
+        self.pattern = pattern
+        # Próximo nombre ya leído pero no entregado, para saber si quedan más
+        self.lookahead = None
+        self.exhausted = False
+
+    def _advance(self, budget=None):
+        """
+        Lee del directorio el próximo nombre que cumpla el patrón,
+        recorriendo como mucho `budget' entradas (None: sin límite).
+
+        Returns:
+            La cantidad de entradas recorridas.
+        """
+        scanned = 0
+        while budget is None or scanned < budget:
+            entry = next(self.iterator, None)
+            if entry is None:
+                self.exhausted = True
+                self.close()
+                break
+            scanned += 1
+            if self.pattern is None or fnmatch.fnmatchcase(entry.name, self.pattern):
+                self.lookahead = entry.name
+                break
+        return scanned
+
+    def take(self, n, max_scan=None):
+        """
+        Devuelve hasta `n' nombres más del directorio.
+
+        Con `max_scan' recorre como mucho esa cantidad de entradas, así que
+        con un patrón que cumplen pocos nombres la página puede quedar
+        corta, o vacía, sin que el listado haya terminado.
+        """
+        names = []
+        budget = max_scan
+        while len(names) < n and not self.exhausted:
+            if self.lookahead is None:
+                scanned = self._advance(budget)
+                if budget is not None:
+                    budget -= scanned
+                if self.lookahead is None:
+                    # Se terminó el directorio o lo que se podía recorrer
+                    break
+            names.append(self.lookahead)
+            self.lookahead = None
+        if self.lookahead is None and not self.exhausted and budget != 0:
+            # Para saber si esta es la última página
+            self._advance(budget)
+        return names
+
+    def close(self):
+        self.iterator.close()
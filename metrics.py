@@ -0,0 +1,285 @@
+# encoding: utf-8
+# Métricas internas del servidor HFTP: contadores por comando, histogramas
+# de latencia, bytes transferidos y conexiones.
+
+import bisect
+import os
+import resource
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Límites superiores (en segundos) de los buckets del histograma de latencia
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Comandos que se reportan con su propio nombre; el resto se agrupa en
+# "invalid" para no crear una serie por cada línea basura que llegue.
+KNOWN_COMMANDS = ("quit", "get_metadata", "get_slice",
+                  "get_file_listing", "list_files", "stats", "protocol",
+                  "get_identity", "watch", "unwatch", "profile")
+
+
+class Histogram(object):
+    """
+    Histograma acumulativo con buckets fijos, al estilo Prometheus.
+    No es thread-safe por sí mismo: lo protege el lock de Metrics.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # El último es +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        Devuelve una lista de pares (límite, cantidad acumulada), con
+        "+Inf" como último límite.
+        """
+        result = []
+        acc = 0
+        for bound, n in zip(self.buckets + ("+Inf",), self.counts):
+            acc += n
+            result.append((bound, acc))
+        return result
+
+
+class Metrics(object):
+    """
+    Registro de métricas compartido por todas las conexiones del servidor.
+
+    Cada observación toma un único lock y hace O(log buckets) trabajo,
+    así que puede quedar activado en producción.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = {}   # comando -> cantidad de pedidos
+        self.codes = {}      # (comando, código) -> cantidad de respuestas
+        self.latency = {}    # comando -> Histogram
+        self.spans = {}      # (comando, etapa) -> Histogram
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.active_connections = 0
+        self.total_connections = 0
+        # Series adicionales registradas por otros módulos:
+        # nombre (con etiquetas) -> valor
+        self.counters = {}
+        self.gauges = {}
+
+    def observe_command(self, cmd, code, elapsed):
+        """
+        Registra un pedido atendido.
+
+        Args:
+            cmd (str): Nombre del comando recibido.
+            code (int): Código con el que se respondió.
+            elapsed (float): Segundos que llevó atenderlo.
+        """
+        if cmd not in KNOWN_COMMANDS:
+            cmd = "invalid"
+        with self.lock:
+            self.requests[cmd] = self.requests.get(cmd, 0) + 1
+            key = (cmd, code)
+            self.codes[key] = self.codes.get(key, 0) + 1
+            hist = self.latency.get(cmd)
+            if hist is None:
+                hist = self.latency[cmd] = Histogram()
+            hist.observe(elapsed)
+
+    def observe_spans(self, cmd, spans):
+        """
+        Registra cuánto llevó cada etapa de un pedido.
+
+        Args:
+            cmd (str): Nombre del comando recibido.
+            spans (dict): Etapa -> segundos.
+        """
+        if cmd not in KNOWN_COMMANDS:
+            cmd = "invalid"
+        with self.lock:
+            for span, elapsed in spans.items():
+                hist = self.spans.get((cmd, span))
+                if hist is None:
+                    hist = self.spans[(cmd, span)] = Histogram()
+                hist.observe(elapsed)
+
+    def add_bytes_in(self, n):
+        with self.lock:
+            self.bytes_in += n
+
+    def add_bytes_out(self, n):
+        with self.lock:
+            self.bytes_out += n
+
+    def connection_opened(self):
+        with self.lock:
+            self.active_connections += 1
+            self.total_connections += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.active_connections -= 1
+
+    def inc_counter(self, name, value=1):
+        """
+        Suma `value' al contador `name', que puede incluir etiquetas
+        (por ejemplo 'hftp_foo_total{kind="bar"}').
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        """
+        Fija el valor del gauge `name'.
+        """
+        with self.lock:
+            self.gauges[name] = value
+
+    def render(self, eol="\n"):
+        """
+        Devuelve todas las métricas en el formato de texto de Prometheus,
+        con `eol' como separador de líneas.
+        """
+        with self.lock:
+            lines = [
+                "# HELP hftp_requests_total Pedidos atendidos por comando.",
+                "# TYPE hftp_requests_total counter",
+            ]
+            for cmd, n in sorted(self.requests.items()):
+                lines.append('hftp_requests_total{command="%s"} %d' % (cmd, n))
+            lines += [
+                "# HELP hftp_responses_total Respuestas por comando y codigo.",
+                "# TYPE hftp_responses_total counter",
+            ]
+            for (cmd, code), n in sorted(self.codes.items()):
+                lines.append('hftp_responses_total{command="%s",code="%d"} %d'
+                             % (cmd, code, n))
+            lines += [
+                "# HELP hftp_request_seconds Latencia de los pedidos por comando.",
+                "# TYPE hftp_request_seconds histogram",
+            ]
+            for cmd, hist in sorted(self.latency.items()):
+                for bound, acc in hist.cumulative():
+                    lines.append('hftp_request_seconds_bucket{command="%s",le="%s"} %d'
+                                 % (cmd, bound, acc))
+                lines.append('hftp_request_seconds_sum{command="%s"} %f'
+                             % (cmd, hist.sum))
+                lines.append('hftp_request_seconds_count{command="%s"} %d'
+                             % (cmd, hist.count))
+            if self.spans:
+                lines += [
+                    "# HELP hftp_request_span_seconds Tiempo por etapa de los pedidos.",
+                    "# TYPE hftp_request_span_seconds histogram",
+                ]
+            for (cmd, span), hist in sorted(self.spans.items()):
+                labels = 'command="%s",span="%s"' % (cmd, span)
+                for bound, acc in hist.cumulative():
+                    lines.append('hftp_request_span_seconds_bucket{%s,le="%s"} %d'
+                                 % (labels, bound, acc))
+                lines.append('hftp_request_span_seconds_sum{%s} %f'
+                             % (labels, hist.sum))
+                lines.append('hftp_request_span_seconds_count{%s} %d'
+                             % (labels, hist.count))
+            lines += [
+                "# TYPE hftp_bytes_received_total counter",
+                "hftp_bytes_received_total %d" % self.bytes_in,
+                "# TYPE hftp_bytes_sent_total counter",
+                "hftp_bytes_sent_total %d" % self.bytes_out,
+                "# TYPE hftp_connections_active gauge",
+                "hftp_connections_active %d" % self.active_connections,
+                "# TYPE hftp_connections_total counter",
+                "hftp_connections_total %d" % self.total_connections,
+                "# TYPE hftp_uptime_seconds gauge",
+                "hftp_uptime_seconds %f" % (time.time() - self.started),
+                "# TYPE hftp_threads gauge",
+                "hftp_threads %d" % threading.active_count(),
+                "# TYPE process_resident_memory_bytes gauge",
+                "process_resident_memory_bytes %d" % resident_memory(),
+            ]
+            lines += _render_series(self.counters, "counter")
+            lines += _render_series(self.gauges, "gauge")
+        return eol.join(lines) + eol
+
+
+def resident_memory():
+    """
+    Devuelve la memoria residente (RSS) del proceso, en bytes. Donde no
+    hay /proc devuelve el máximo alcanzado, que es lo que informa getrusage.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # En Linux getrusage informa KiB; en macOS, bytes
+        return maxrss if os.uname().sysname == "Darwin" else maxrss * 1024
+
+
+def _render_series(series, kind):
+    """
+    Devuelve las líneas de texto de un conjunto de series, agrupadas por
+    nombre de métrica con su línea TYPE.
+    """
+    lines = []
+    last = None
+    for name, value in sorted(series.items()):
+        base = name.split("{", 1)[0]
+        if base != last:
+            lines.append("# TYPE %s %s" % (base, kind))
+            last = base
+        if isinstance(value, float):
+            lines.append("%s %f" % (name, value))
+        else:
+            lines.append("%s %d" % (name, value))
+    return lines
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Atiende GET /metrics con el texto de Prometheus.
+    """
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Los scrapes periódicos no deben ensuciar la salida del servidor
+        pass
+
+
+def start_http_server(metrics, addr, port, sock=None):
+    """
+    Lanza, en un hilo daemon, un servidor HTTP que expone `metrics'. Si se
+    pasa `sock', atiende en ese socket ya vinculado y escuchando (heredado
+    de otro proceso) en lugar de crear uno.
+
+    Devuelve el ThreadingHTTPServer creado (para poder cerrarlo).
+    """
+    if sock is None:
+        httpd = ThreadingHTTPServer((addr, port), _MetricsHandler)
+    else:
+        httpd = ThreadingHTTPServer((addr, port), _MetricsHandler,
+                                    bind_and_activate=False)
+        httpd.socket.close()
+        httpd.socket = sock
+    httpd.daemon_threads = True
+    httpd.metrics = metrics
+    t = threading.Thread(target=httpd.serve_forever, daemon=True)
+    t.start()
+    return httpd
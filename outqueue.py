@@ -0,0 +1,182 @@
+# encoding: utf-8
+# Cola de salida de una conexión del servidor HFTP.
+
+import collections
+import select
+import socket
+
+# Máxima cantidad de buffers que se entregan juntos a sendmsg
+MAX_IOV = 64
+
+
+class OutputQueue(object):
+    """
+    Bytes pendientes de enviar a un cliente, con marcas de agua alta y baja.
+
+    Los productores agregan datos con append() y consultan full(): cuando
+    se supera la marca alta deben dejar de producir hasta que la cola baje
+    de la marca baja, vaciándola con drain() o esperando a que otro la
+    vacíe con send(). Así la memoria retenida por un cliente que lee
+    despacio queda acotada a la marca alta más un chunk. Vacía no ocupa
+    más que sus atributos.
+    """
+
+    __slots__ = ("high", "low", "chunks", "size")
+
+    def __init__(self, high, low):
+        """
+        Args:
+            high (int): Marca de agua alta, en bytes.
+            low (int): Marca de agua baja, en bytes. Debe ser menor que `high'.
+        """
+        if not 0 <= low < high:
+            raise ValueError("OutputQueue: se requiere 0 <= low < high")
+        self.high = high
+        self.low = low
+        # Se crea con el primer append() y se descarta al vaciarse
+        self.chunks = None
+        self.size = 0
+
+    def append(self, data: bytes):
+        """
+        Encola `data' para enviarlo más tarde.
+        """
+        if data:
+            if self.chunks is None:
+                self.chunks = collections.deque()
+            self.chunks.append(memoryview(data))
+            self.size += len(data)
+
+    def clear(self):
+        """
+        Descarta todo lo encolado, por ejemplo si el cliente se desconectó.
+        """
+        self.chunks = None
+        self.size = 0
+
+    def full(self):
+        """
+        Devuelve True si la cola superó la marca de agua alta.
+        """
+        return self.size >= self.high
+
+    def send(self, sock):
+        """
+        Envía por el socket no bloqueante `sock' todo lo que acepte sin
+        bloquearse.
+
+        Returns:
+            La cantidad de bytes enviados.
+
+        Raises:
+            OSError: Si falla el envío.
+        """
+        total = 0
+        while self.size:
+            try:
+                sent = self._send(sock)
+            except BlockingIOError:
+                break
+            self._consume(sent)
+            total += sent
+        if not self.size:
+            self.chunks = None
+        return total
+
+    def drain(self, sock, target=0, timeout=None):
+        """
+        Envía datos por `sock' hasta que queden como mucho `target' bytes
+        encolados. Varios buffers chicos se envían juntos con sendmsg.
+
+        Sirve tanto para sockets bloqueantes (con o sin timeout) como para
+        no bloqueantes: en ese caso espera con wait_socket() a poder escribir.
+
+        Raises:
+            socket.timeout: Si pasan `timeout' segundos sin poder escribir
+                en un socket no bloqueante. Los sockets con timeout propio
+                lo lanzan directamente.
+            OSError: Si falla el envío.
+        """
+        while self.size > target:
+            try:
+                sent = self._send(sock)
+            except BlockingIOError:
+                if not wait_socket(sock, True, timeout):
+                    raise socket.timeout("send timed out")
+                continue
+            self._consume(sent)
+        if not self.size:
+            self.chunks = None
+
+    def _send(self, sock):
+        """
+        Hace un envío por `sock'. Varios buffers chicos se envían juntos
+        con sendmsg.
+        """
+        if len(self.chunks) > 1 and hasattr(sock, "sendmsg"):
+            return sock.sendmsg(list(_take(self.chunks, MAX_IOV)))
+        return sock.send(self.chunks[0])
+
+    def _consume(self, n):
+        """
+        Descarta los primeros `n' bytes encolados (ya enviados).
+        """
+        self.size -= n
+        while n:
+            head = self.chunks[0]
+            if n >= len(head):
+                n -= len(head)
+                self.chunks.popleft()
+            else:
+                self.chunks[0] = head[n:]
+                n = 0
+
+
+def wait_socket(sock, writable, timeout, wakeup=None):
+    """
+    Espera a que se pueda leer de (o, si `writable', escribir en) `sock'.
+    Si se da `wakeup', también vuelve cuando hay algo para leer en él.
+
+    Returns:
+        False si pasaron `timeout' segundos sin que el socket esté listo.
+    """
+    return poll_socket(sock, not writable, writable, timeout, wakeup)
+
+
+def poll_socket(sock, read, write, timeout, wakeup=None):
+    """
+    Espera a que se pueda leer de `sock' (si `read') o escribir en él (si
+    `write'). Si se da `wakeup', también vuelve cuando hay algo para leer
+    en él.
+
+    Usa poll() donde existe, que a diferencia de select() no tiene límite
+    en el número de descriptor.
+
+    Returns:
+        False si pasaron `timeout' segundos sin que nada esté listo.
+    """
+    if hasattr(select, "poll"):
+        poller = select.poll()
+        events = (select.POLLIN if read else 0) | (select.POLLOUT if write else 0)
+        if events:
+            # Sin eventos pedidos poll() igual avisaría si el otro extremo cerró
+            poller.register(sock, events)
+        if wakeup is not None:
+            poller.register(wakeup, select.POLLIN)
+        return bool(poller.poll(None if timeout is None else timeout * 1000))
+    readers = [sock] if read else []
+    if wakeup is not None:
+        readers.append(wakeup)
+    ready_r, ready_w, _ = select.select(readers, [sock] if write else [], [],
+                                        timeout)
+    return bool(ready_r or ready_w)
+
+
+def _take(chunks, n):
+    """
+    Devuelve los primeros `n' elementos de la deque `chunks'.
+    """
+    for i, chunk in enumerate(chunks):
+        if i == n:
+            break
+        yield chunk
@@ -0,0 +1,272 @@
+# encoding: utf-8
+# Profiling a pedido de un servidor HFTP en ejecución.
+
+import cProfile
+import collections
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+logger = logging.getLogger("hftp.profiler")
+
+# Modos de profiling:
+# MODE_SAMPLE: muestrea las pilas de todos los hilos cada SAMPLE_INTERVAL
+#     segundos y las guarda en formato "collapsed" (el de flamegraph.pl).
+#     Casi no agrega overhead y ve también los hilos bloqueados.
+# MODE_CPROFILE: perfila con cProfile cada pedido atendido, en el hilo que
+#     lo atienda, y guarda los resultados combinados en formato pstats.
+#     Desde Python 3.12 cProfile usa sys.monitoring, que admite un solo
+#     perfil activo en todo el proceso: ahí este modo no está disponible.
+MODE_SAMPLE = "sample"
+MODE_CPROFILE = "cprofile"
+if sys.version_info < (3, 12):
+    MODES = (MODE_SAMPLE, MODE_CPROFILE)
+else:
+    MODES = (MODE_SAMPLE,)
+
+SAMPLE_INTERVAL = 0.005
+# Segundos que se espera a los pedidos perfilados en curso al terminar
+# una sesión de cProfile
+STOP_TIMEOUT = 5.0
+
+
+class SamplingSession(object):
+    """
+    Muestreo periódico de las pilas de todos los hilos del proceso.
+    """
+
+    extension = "collapsed"
+
+    def __init__(self, path, interval=SAMPLE_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="hftp-profiler",
+                                       daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    self.counts[_collapse(frame)] += 1
+
+    def begin(self):
+        return None
+
+    def stop(self):
+        """
+        Termina el muestreo y escribe el resultado.
+        """
+        self.stopped.set()
+        self.thread.join()
+        with open(self.path, "w") as f:
+            for stack, n in self.counts.most_common():
+                f.write("%s %d\n" % (stack, n))
+
+
+class CProfileSession(object):
+    """
+    cProfile de los pedidos atendidos mientras dura la sesión. Cada hilo
+    usa su propio cProfile.Profile, porque uno solo no puede perfilar
+    varios hilos; al terminar se combinan.
+    """
+
+    extension = "pstats"
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.profiles = []
+        # Pedidos perfilándose en este momento
+        self.active = 0
+        self.closed = False
+        self.done = threading.Condition()
+
+    def begin(self):
+        """
+        Empieza a perfilar el pedido que atiende el hilo actual.
+
+        Returns:
+            El cProfile.Profile del hilo, a pasar a end(), o None si la
+            sesión ya terminó.
+
+        Raises:
+            ValueError: Si hay otro profiling activo en el proceso.
+        """
+        profile = getattr(self.local, "profile", None)
+        with self.done:
+            if self.closed:
+                return None
+            self.active += 1
+        if profile is None:
+            profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Hay otra herramienta de profiling activa en el proceso
+            with self.done:
+                self.active -= 1
+                self.done.notify_all()
+            raise
+        if getattr(self.local, "profile", None) is None:
+            # Solo se combinan los perfiles que llegaron a activarse
+            self.local.profile = profile
+            with self.done:
+                self.profiles.append(profile)
+        return profile
+
+    def end(self, profile):
+        profile.disable()
+        with self.done:
+            self.active -= 1
+            self.done.notify_all()
+
+    def stop(self):
+        """
+        Combina los perfiles de todos los hilos y escribe el resultado.
+        """
+        with self.done:
+            self.closed = True
+            # Un perfil solo se puede leer desde su hilo mientras está activo
+            if not self.done.wait_for(lambda: not self.active, STOP_TIMEOUT):
+                logger.warning("Dumping profile with requests still running")
+            profiles = list(self.profiles)
+        stats = pstats.Stats(*profiles) if profiles else pstats.Stats()
+        stats.dump_stats(self.path)
+
+
+class Profiler(object):
+    """
+    Arranca y detiene sesiones de profiling en un server que ya está
+    atendiendo, sin reiniciarlo. Hay como mucho una sesión a la vez, y
+    termina sola pasados los segundos pedidos.
+
+    También guarda si hay que medir las etapas de cada pedido (parse,
+    validate, read, encode, send), lo que se puede cambiar en caliente.
+    """
+
+    def __init__(self, directory, spans=False):
+        """
+        Args:
+            directory (str): Directorio donde se escriben los resultados.
+            spans (bool): Si se miden las etapas de cada pedido.
+        """
+        self.directory = directory
+        self.spans = spans
+        self.lock = threading.Lock()
+        self.session = None
+        self.timer = None
+        # Sesiones arrancadas, para no repetir nombres de archivo
+        self.count = 0
+
+    def start(self, mode, seconds):
+        """
+        Arranca una sesión de `seconds' segundos en el modo `mode'.
+
+        Returns:
+            La ruta del archivo donde se escribirá el resultado.
+
+        Raises:
+            ValueError: Si el modo o la duración no son válidos.
+            RuntimeError: Si ya hay una sesión en curso.
+        """
+        if mode not in MODES or not seconds > 0:
+            raise ValueError("modo o duración inválidos")
+        with self.lock:
+            if self.session is not None:
+                raise RuntimeError("ya hay una sesión de profiling en curso")
+            os.makedirs(self.directory, exist_ok=True)
+            self.count += 1
+            kind = SamplingSession if mode == MODE_SAMPLE else CProfileSession
+            name = "hftp-%d-%s-%d.%s" % (os.getpid(),
+                                          time.strftime("%Y%m%d-%H%M%S"),
+                                          self.count, kind.extension)
+            path = os.path.join(self.directory, name)
+            self.session = kind(path)
+            self.timer = threading.Timer(seconds, self._expire, (self.session,))
+            self.timer.daemon = True
+            self.timer.start()
+        logger.info("Profiling (%s) for %ss into %s", mode, seconds, path)
+        return path
+
+    def stop(self):
+        """
+        Termina la sesión en curso y escribe su resultado.
+
+        Returns:
+            La ruta del resultado, o None si no había sesión.
+        """
+        with self.lock:
+            session, self.session = self.session, None
+            if session is None:
+                return None
+            self.timer.cancel()
+        return self._finish(session)
+
+    def _finish(self, session):
+        session.stop()
+        logger.info("Profile written to %s", session.path)
+        return session.path
+
+    def toggle(self, mode, seconds):
+        """
+        Detiene la sesión en curso o, si no hay, arranca una. Pensado para
+        una señal, donde no hay a quién devolverle un error.
+        """
+        if self.stop() is None:
+            try:
+                self.start(mode, seconds)
+            except RuntimeError:
+                # Otra sesión arrancó mientras tanto
+                pass
+
+    def _expire(self, session):
+        with self.lock:
+            if self.session is not session:
+                # La detuvieron antes de tiempo
+                return
+            self.session = None
+        self._finish(session)
+
+    def begin_request(self):
+        """
+        Empieza a perfilar el pedido que el hilo actual está por atender,
+        si hay una sesión de cProfile en curso.
+
+        Returns:
+            Lo que hay que pasarle a end_request() al terminar el pedido.
+            Si no se lo pudo perfilar, el pedido se atiende igual.
+        """
+        session = self.session
+        if session is None:
+            return None
+        try:
+            profile = session.begin()
+        except Exception:
+            logger.exception("Could not profile request")
+            return None
+        return (session, profile) if profile is not None else None
+
+    def end_request(self, token):
+        if token is not None:
+            session, profile = token
+            session.end(profile)
+
+
+def _collapse(frame):
+    """
+    Devuelve la pila que termina en `frame' en formato "collapsed": las
+    funciones desde la raíz, separadas por punto y coma.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return ";".join(reversed(names))
@@ -0,0 +1,80 @@
+# encoding: utf-8
+# Limitación de ancho de banda para las transferencias de datos del
+# servidor HFTP.
+
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Token bucket de `rate' bytes por segundo con capacidad `burst'.
+
+    consume() reserva los bytes pedidos aunque el bucket quede en negativo
+    y duerme lo que haga falta para pagar esa deuda. Así cada llamada
+    obtiene su turno en orden de llegada: si varias transferencias piden
+    de a un chunk, el ancho de banda se reparte entre ellas chunk a chunk.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        Args:
+            rate (int): Bytes por segundo permitidos.
+            burst (int): Bytes que se pueden enviar de golpe. Por defecto,
+                lo equivalente a un segundo de `rate'.
+        """
+        if rate <= 0:
+            raise ValueError("TokenBucket: rate debe ser positivo")
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        """
+        Toma `n' bytes del bucket, esperando si no alcanzan.
+
+        Returns:
+            Los segundos que se esperó.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class Shaper(object):
+    """
+    Limita el envío de datos de una conexión según su propio bucket y,
+    si existe, el bucket global compartido por todas las conexiones.
+    """
+
+    def __init__(self, rate=None, global_bucket=None, burst=None):
+        """
+        Args:
+            rate (int): Bytes por segundo para esta conexión, o None para
+                no limitarla individualmente.
+            global_bucket (TokenBucket): Bucket compartido, o None.
+            burst (int): Capacidad del bucket de la conexión.
+        """
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.global_bucket = global_bucket
+
+    def consume(self, n):
+        """
+        Espera hasta poder enviar `n' bytes. Devuelve los segundos que
+        se esperó.
+        """
+        waited = 0.0
+        if self.bucket is not None:
+            waited += self.bucket.consume(n)
+        if self.global_bucket is not None:
+            waited += self.global_bucket.consume(n)
+        return waited
@@ -7,17 +7,26 @@
 
 import unittest
 import client
+import json
+import cache
 import constants
 import select
 import time
 import socket
 import os
 import os.path
+import pstats
+import profiler
+import resource
 import logging
+import signal
+import subprocess
 import sys
+import threading
 
 DATADIR = 'testdata'
 TIMEOUT = 3  # Una cantidad razonable de segundos para esperar respuestas
+UNIX_SOCKET = None  # Socket Unix del server, si escucha en uno
 
 
 class TestBase(unittest.TestCase):
@@ -57,6 +66,28 @@ class TestBase(unittest.TestCase):
         return self.client
 
 
+def start_server(port, args, **kwargs):
+    """
+    Lanza un server propio en el puerto `port' con las opciones `args',
+    para los tests que necesitan otra configuración, y espera a que
+    acepte conexiones. `kwargs' se pasan a subprocess.Popen.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    server = subprocess.Popen([sys.executable, path, '-p', str(port),
+                               '-d', DATADIR, '--log-level', 'ERROR'] + args,
+                              **kwargs)
+    deadline = time.time() + TIMEOUT
+    while True:
+        try:
+            socket.create_connection((constants.DEFAULT_ADDR, port)).close()
+            return server
+        except socket.error:
+            if time.time() > deadline:
+                server.kill()
+                raise
+            time.sleep(0.1)
+
+
 class TestHFTPServer(TestBase):
 
     # Tests
@@ -171,6 +202,171 @@ class TestHFTPServer(TestBase):
         f.close()
         c.close()
 
+    def test_list_files_pages(self):
+        correct_list = []
+        for i in range(25):
+            filename = 'page%02d' % i
+            open(os.path.join(DATADIR, filename), 'w').close()
+            correct_list.append(filename)
+        open(os.path.join(DATADIR, 'other'), 'w').close()
+        c = self.new_client()
+        names, cursor = c.list_files("0", 10, 'page*')
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(len(names), 10)
+        self.assertNotEqual(cursor, "0")
+        files = sorted(c.iter_files('page*', 10))
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(files, correct_list,
+                         "El listado paginado no es el correcto")
+        self.assertEqual(sorted(c.iter_files()), ['other'] + correct_list)
+        c.list_files("12345", 10)
+        self.assertEqual(c.status, constants.INVALID_ARGUMENTS,
+                         "El servidor no contestó 201 ante un cursor inválido")
+        c.close()
+
+    def test_list_files_selective_pattern(self):
+        for i in range(constants.MAX_PAGE_SCAN + 10):
+            open(os.path.join(DATADIR, 'f%05d' % i), 'w').close()
+        open(os.path.join(DATADIR, 'zzz'), 'w').close()
+        c = self.new_client()
+        # Una página no recorre todo el directorio buscando coincidencias
+        names, cursor = c.list_files("0", 10, 'zzz?')
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(names, [])
+        self.assertNotEqual(cursor, "0")
+        self.assertEqual(list(c.iter_files('zzz?', 10)), [])
+        self.assertEqual(list(c.iter_files('zzz', 10)), ['zzz'])
+        c.close()
+
+    def test_get_identity(self):
+        path = os.path.join(DATADIR, 'bar')
+        f = open(path, 'w')
+        f.write('data')
+        f.close()
+        c = self.new_client()
+        st = os.stat(path)
+        self.assertEqual(c.get_identity('bar'), (4, st.st_mtime_ns))
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertIsNone(c.get_identity('does_not_exist'))
+        self.assertEqual(c.status, constants.FILE_NOT_FOUND)
+        c.close()
+
+    def test_retrieve_cached(self):
+        self.output_file = 'bar'
+        cachedir = 'testcache'
+        os.system('rm -rf %s' % cachedir)
+        path = os.path.join(DATADIR, self.output_file)
+        f = open(path, 'w')
+        f.write('first')
+        f.close()
+        c = self.new_client()
+        c.cache = cache.FileCache(cachedir, 2**20)
+        c.retrieve(self.output_file)
+        slices = c.stats().get('hftp_requests_total{command="get_slice"}', 0)
+        # Sin cambios en el server, la segunda vez no se baja nada
+        os.remove(self.output_file)
+        c.retrieve(self.output_file)
+        self.assertEqual(open(self.output_file).read(), 'first')
+        self.assertEqual(
+            c.stats().get('hftp_requests_total{command="get_slice"}', 0), slices)
+        # Si el archivo cambia, se vuelve a bajar
+        f = open(path, 'w')
+        f.write('second')
+        f.close()
+        c.retrieve(self.output_file)
+        self.assertEqual(open(self.output_file).read(), 'second')
+        c.close()
+        os.system('rm -rf %s' % cachedir)
+
+    def test_watch(self):
+        path = os.path.join(DATADIR, 'bar')
+        c = self.new_client()
+        self.assertTrue(c.watch())
+        f = open(path, 'w')
+        f.write('data')
+        f.close()
+        self.assertEqual(c.read_event(TIMEOUT), ('add', 'bar'))
+        # Mientras tanto se pueden seguir haciendo pedidos
+        self.assertEqual(c.get_metadata('bar'), 4)
+        f = open(path, 'a')
+        f.write('more')
+        f.close()
+        self.assertEqual(c.read_event(TIMEOUT), ('modify', 'bar'))
+        os.remove(path)
+        self.assertEqual(c.read_event(TIMEOUT), ('delete', 'bar'))
+        c.unwatch()
+        self.assertEqual(c.status, constants.CODE_OK)
+        c.close()
+
+    def test_profile(self):
+        self.output_file = 'bar'
+        f = open(os.path.join(DATADIR, 'bar'), 'w')
+        f.write('data')
+        f.close()
+        c = self.new_client()
+        # Muestreo de todos los hilos
+        path = c.profile('start', 'sample', 10)
+        self.assertEqual(c.status, constants.CODE_OK)
+        c.get_metadata('bar')
+        time.sleep(0.1)
+        self.assertEqual(c.profile('stop'), path)
+        self.assertTrue(open(path).readline().strip(),
+                        "El profiling por muestreo no registró pilas")
+        os.remove(path)
+        # cProfile de los pedidos, que no existe desde Python 3.12
+        path = c.profile('start', 'cprofile', 10)
+        if profiler.MODE_CPROFILE not in profiler.MODES:
+            self.assertEqual(c.status, constants.INVALID_ARGUMENTS)
+            return
+        c.get_slice('bar', 0, 4)
+        # Los pedidos concurrentes se perfilan cada uno en su hilo y todos
+        # reciben respuesta
+        c2 = client.Client()
+        self.assertTrue(c2.negotiate())
+        slices = [c2.submit('get_slice bar 0 4') for i in range(3)]
+        for request_id in slices:
+            self.assertEqual(c2.wait_response(request_id, TIMEOUT),
+                             (constants.CODE_OK, b'data'))
+        c2.close()
+        self.assertEqual(c.profile('stop'), path)
+        functions = [func for _, _, func in pstats.Stats(path).stats]
+        self.assertIn('get_slice', functions)
+        os.remove(path)
+        self.assertIsNone(c.profile('stop'))
+        self.assertEqual(c.status, constants.INVALID_ARGUMENTS)
+        c.close()
+
+    def test_request_spans(self):
+        self.output_file = 'bar'
+        f = open(os.path.join(DATADIR, 'bar'), 'w')
+        f.write('data')
+        f.close()
+        c = self.new_client()
+        self.assertEqual(c.profile('spans', 'on'), 'on')
+        c.get_slice('bar', 0, 4)
+        stats = c.stats()
+        c.profile('spans', 'off')
+        for span in ('parse', 'validate', 'read', 'encode', 'send'):
+            self.assertGreaterEqual(
+                stats.get('hftp_request_span_seconds_count'
+                          '{command="get_slice",span="%s"}' % span, 0), 1)
+        c.close()
+
+    def test_stats(self):
+        open(os.path.join(DATADIR, 'bar'), 'w').close()
+        c = self.new_client()
+        c.get_metadata('bar')
+        c.get_metadata('does_not_exist')
+        stats = c.stats()
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertGreaterEqual(
+            stats.get('hftp_requests_total{command="get_metadata"}', 0), 2)
+        self.assertGreaterEqual(
+            stats.get('hftp_responses_total{command="get_metadata",code="%d"}'
+                      % constants.FILE_NOT_FOUND, 0), 1)
+        self.assertGreaterEqual(stats.get('hftp_connections_active', 0), 1)
+        c.close()
+
 
 class TestHFTPErrors(TestBase):
 
@@ -282,25 +478,604 @@ class TestHFTPHard(TestBase):
         c.close()
 
 
+class TestHFTPv2(TestBase):
+
+    def new_client(self):
+        c = super().new_client()
+        self.assertTrue(c.negotiate(),
+                        "El servidor no aceptó la versión 2 del protocolo")
+        return c
+
+    def test_v2_metadata_and_slice(self):
+        self.output_file = 'bar'
+        test_data = 'x' * 100 + '\0' * 100 + 'y' * 100000
+        f = open(os.path.join(DATADIR, self.output_file), 'w')
+        f.write(test_data)
+        f.close()
+        c = self.new_client()
+        self.assertEqual(c.get_metadata(self.output_file), len(test_data))
+        self.assertEqual(c.status, constants.CODE_OK)
+        c.get_slice(self.output_file, 0, len(test_data))
+        self.assertEqual(c.status, constants.CODE_OK)
+        f = open(self.output_file)
+        self.assertEqual(f.read(), test_data,
+                         "El contenido del archivo no es el correcto")
+        f.close()
+        self.assertEqual(sorted(c.iter_files('b*', 1)), ['bar'])
+        c.close()
+        self.assertEqual(c.status, constants.CODE_OK)
+
+    def test_v2_lookup(self):
+        open(os.path.join(DATADIR, 'bar'), 'w').close()
+        open(os.path.join(DATADIR, 'foo'), 'w').close()
+        c = self.new_client()
+        self.assertEqual(sorted(c.file_lookup()), ['bar', 'foo'])
+        self.assertEqual(c.status, constants.CODE_OK)
+        os.remove(os.path.join(DATADIR, 'bar'))
+        os.remove(os.path.join(DATADIR, 'foo'))
+        self.assertEqual(c.file_lookup(), [])
+        c.close()
+
+    def test_v2_errors(self):
+        c = self.new_client()
+        code, message = c.request('verdura')
+        self.assertEqual(code, constants.INVALID_COMMAND)
+        # Un frame vacío también tiene respuesta bajo su id
+        for command in ('', '  '):
+            code, message = c.request(command)
+            self.assertEqual(code, constants.INVALID_COMMAND)
+        code, message = c.request('get_metadata does_not_exist')
+        self.assertEqual(code, constants.FILE_NOT_FOUND)
+        self.assertEqual(message.decode("ascii"),
+                         constants.error_messages[constants.FILE_NOT_FOUND])
+        c.close()
+
+    def test_v2_request_ids(self):
+        f = open(os.path.join(DATADIR, 'bar'), 'w')
+        f.write('data')
+        f.close()
+        c = self.new_client()
+        # Dos pedidos seguidos; reclamamos primero la respuesta del segundo
+        first = c.submit('get_metadata bar')
+        second = c.submit('get_slice bar 1 2')
+        self.assertEqual(c.wait_response(second),
+                         (constants.CODE_OK, b'at'))
+        self.assertEqual(c.wait_response(first), (constants.CODE_OK, b'4\n'))
+        c.close()
+
+    def test_v2_concurrent_requests(self):
+        f = open(os.path.join(DATADIR, 'bar'), 'w')
+        f.write('z' * 2**20)
+        f.close()
+        c = self.new_client()
+        # Las transferencias y los metadatos se atienden en paralelo; las
+        # respuestas se arman a partir de frames intercalados
+        slices = [c.submit('get_slice bar 0 %d' % 2**20) for i in range(4)]
+        meta = c.submit('get_metadata bar')
+        self.assertEqual(c.wait_response(meta), (constants.CODE_OK, b'1048576\n'))
+        for rid in slices:
+            self.assertEqual(c.wait_response(rid),
+                             (constants.CODE_OK, b'z' * 2**20))
+        c.close()
+
+    def test_v2_concurrent_list_files(self):
+        for name in ('bar', 'baz', 'foo'):
+            open(os.path.join(DATADIR, name), 'w').close()
+        c = self.new_client()
+        # Más listados abiertos a la vez que los que guarda la conexión:
+        # todos responden aunque se descarten los más viejos
+        pages = [c.submit('list_files 0 1') for i in range(32)]
+        for request_id in pages:
+            code, data = c.wait_response(request_id, TIMEOUT)
+            self.assertEqual(code, constants.CODE_OK)
+            cursor, name = data.decode("ascii").split(constants.EOL)[:2]
+            self.assertIn(name, ('bar', 'baz', 'foo'))
+        c.close()
+
+    def test_v2_watch(self):
+        c = self.new_client()
+        self.assertTrue(c.watch())
+        open(os.path.join(DATADIR, 'bar'), 'w').close()
+        self.assertEqual(c.read_event(TIMEOUT), ('add', 'bar'))
+        c.unwatch()
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertIsNone(c.read_event())
+        c.close()
+
+    def test_v2_frame_too_big(self):
+        c = self.new_client()
+        c.s.send(b'\xff\xff\xff\xff\x00\x00\x00\x01')
+        code, message = c.wait_response(0)
+        self.assertEqual(code, constants.BAD_REQUEST,
+                         "El servidor no contestó 101 ante un frame enorme")
+
+    def test_v2_eof_closes_silently(self):
+        c = self.new_client()
+        self.assertEqual(c.get_metadata('does_not_exist'), None)
+        c.s.shutdown(socket.SHUT_WR)
+        c.s.settimeout(TIMEOUT)
+        # Al cerrar el cliente no llega ningún frame más
+        self.assertEqual(c.s.recv(1024), b'')
+        c.connected = False
+
+
+class SpawnedServerBase(TestBase):
+    """
+    Base de los tests que lanzan su propio server, en el puerto PORT y con
+    las opciones SERVER_ARGS.
+    """
+
+    PORT = None
+    SERVER_ARGS = []
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = start_server(cls.PORT, cls.SERVER_ARGS)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+        cls.server.wait()
+
+    def new_client(self):
+        assert not hasattr(self, 'client')
+        self.client = client.Client(constants.DEFAULT_ADDR, self.PORT)
+        return self.client
+
+    def raw_connect(self):
+        s = socket.create_connection((constants.DEFAULT_ADDR, self.PORT))
+        s.settimeout(TIMEOUT)
+        return s
+
+    def read_until_closed(self, s):
+        """
+        Lee de `s' hasta que el server cierre la conexión. Devuelve lo
+        leído.
+        """
+        data = b''
+        got = s.recv(2**16)
+        while got:
+            data += got
+            got = s.recv(2**16)
+        return data
+
+
+class TestHFTPTimeouts(SpawnedServerBase):
+    """
+    Timeouts de las conexiones, con plazos cortos y ancho de banda limitado
+    para que las transferencias duren más que los plazos.
+    """
+
+    PORT = constants.DEFAULT_PORT + 1
+    SERVER_ARGS = ['--idle-timeout', '2', '--request-timeout', '1',
+                   '--rate-limit', '100000']
+
+    def test_idle_timeout(self):
+        s = self.raw_connect()
+        start = time.time()
+        self.assertEqual(self.read_until_closed(s), b'',
+                         "El server no cerró la conexión ociosa")
+        self.assertGreater(time.time() - start, 1.5)
+        s.close()
+
+    def test_request_timeout(self):
+        s = self.raw_connect()
+        # Un pedido que nunca se completa se corta antes del idle timeout
+        s.send(b'get_meta')
+        start = time.time()
+        self.assertEqual(self.read_until_closed(s), b'',
+                         "El server no cortó el pedido incompleto")
+        self.assertLess(time.time() - start, 1.8)
+        s.close()
+
+    def test_pipelined_request_after_long_slice(self):
+        f = open(os.path.join(DATADIR, 'bar'), 'w')
+        f.write('x' * 225000)
+        f.close()
+        c = self.new_client()
+        # El principio del pedido siguiente espera en el buffer mientras se
+        # envía un slice que dura más que el request timeout: su plazo
+        # corre recién cuando el server vuelve a esperar al cliente
+        c.s.sendall(b'get_slice bar 0 225000\r\nget_meta')
+        status, message = c.read_response_line(TIMEOUT)
+        self.assertEqual(status, constants.CODE_OK)
+        self.assertEqual(c.read_fragment(225000), b'x' * 225000)
+        # El cliente tarda un poco en completar el pedido, dentro del plazo
+        time.sleep(0.2)
+        c.s.sendall(b'data bar\r\n')
+        self.assertEqual(c.read_response_line(TIMEOUT),
+                         (constants.CODE_OK, 'OK'))
+        self.assertEqual(c.read_line(TIMEOUT), '225000')
+        c.close()
+
+    def test_v2_transfer_outlasts_idle_timeout(self):
+        f = open(os.path.join(DATADIR, 'bar'), 'w')
+        f.write('x' * 400000)
+        f.close()
+        c = self.new_client()
+        self.assertTrue(c.negotiate())
+        # En la versión 2 el hilo de la conexión espera al cliente mientras
+        # se envía el slice, pero la conexión no está ociosa
+        start = time.time()
+        code, data = c.request('get_slice bar 0 400000')
+        self.assertGreater(time.time() - start, 2)
+        self.assertEqual(code, constants.CODE_OK)
+        self.assertEqual(data, b'x' * 400000)
+        c.close()
+
+    def test_v2_slice_cut(self):
+        path = os.path.join(DATADIR, 'bar')
+        f = open(path, 'w')
+        f.write('x' * 400000)
+        f.close()
+        c = self.new_client()
+        self.assertTrue(c.negotiate())
+        request_id = c.submit('get_slice bar 0 400000')
+        time.sleep(0.5)
+        # El archivo se vacía a mitad del envío: el server corta la conexión
+        # sin el último frame y la respuesta no cuenta como completa
+        open(path, 'w').close()
+        self.assertEqual(c.wait_response(request_id), (None, None))
+
+    def test_retrieve_cut_not_cached(self):
+        self.check_retrieve_cut(self.new_client())
+
+    def test_v2_retrieve_cut_not_cached(self):
+        c = self.new_client()
+        self.assertTrue(c.negotiate())
+        self.check_retrieve_cut(c)
+
+    def check_retrieve_cut(self, c):
+        """
+        Una descarga que el server corta no cuenta como exitosa, no deja
+        archivo y no queda en la caché.
+        """
+        self.output_file = 'bar'
+        cachedir = 'testcache'
+        os.system('rm -rf %s' % cachedir)
+        path = os.path.join(DATADIR, self.output_file)
+        f = open(path, 'w')
+        f.write('x' * 400000)
+        f.close()
+        c.cache = cache.FileCache(cachedir, 2**20)
+        identity = c.get_identity(self.output_file)
+        # El archivo se vacía a mitad de la descarga
+        cut = threading.Timer(0.5, lambda: open(path, 'w').close())
+        cut.start()
+        c.retrieve(self.output_file)
+        cut.join()
+        self.assertNotEqual(c.status, constants.CODE_OK)
+        self.assertFalse(os.path.exists(self.output_file))
+        # La copia incompleta no quedó en la caché con la identidad original
+        key = cache.FileCache.key(c.server, self.output_file, *identity)
+        self.assertFalse(c.cache.fetch(key, self.output_file))
+        os.system('rm -rf %s' % cachedir)
+
+
+class TestHFTPLimits(SpawnedServerBase):
+    """
+    Send timeout y límites de conexiones simultáneas, en total y por
+    dirección. Los clientes del socket Unix no tienen límite por dirección.
+    """
+
+    PORT = constants.DEFAULT_PORT + 2
+    UNIX_SOCKET = 'testlimits.sock'
+    SERVER_ARGS = ['--send-timeout', '1', '--max-connections', '3',
+                   '--max-per-ip', '2', '-u', UNIX_SOCKET]
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        if os.path.exists(cls.UNIX_SOCKET):
+            os.remove(cls.UNIX_SOCKET)
+
+    def setUp(self):
+        super().setUp()
+        # Las conexiones de los tests anteriores se liberan al cerrarse
+        time.sleep(0.5)
+
+    def assertRejected(self, s):
+        busy = '%d %s\r\n' % (constants.SERVER_BUSY,
+                               constants.error_messages[constants.SERVER_BUSY])
+        self.assertEqual(self.read_until_closed(s), busy.encode("ascii"))
+        s.close()
+
+    def test_max_per_ip(self):
+        clients = [client.Client(constants.DEFAULT_ADDR, self.PORT)
+                   for i in range(2)]
+        for c in clients:
+            c.get_metadata('does_not_exist')
+            self.assertEqual(c.status, constants.FILE_NOT_FOUND)
+        self.assertRejected(self.raw_connect())
+        for c in clients:
+            c.close()
+
+    def test_max_connections(self):
+        clients = [client.Client(constants.DEFAULT_ADDR, self.PORT)
+                   for i in range(2)]
+        clients.append(client.Client(unix_path=self.UNIX_SOCKET))
+        for c in clients:
+            c.get_metadata('does_not_exist')
+            self.assertEqual(c.status, constants.FILE_NOT_FOUND)
+        # El límite total también vale para el socket Unix
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(TIMEOUT)
+        s.connect(self.UNIX_SOCKET)
+        self.assertRejected(s)
+        for c in clients:
+            c.close()
+
+    def test_unix_not_limited_per_ip(self):
+        clients = [client.Client(unix_path=self.UNIX_SOCKET) for i in range(3)]
+        for c in clients:
+            c.get_metadata('does_not_exist')
+            self.assertEqual(c.status, constants.FILE_NOT_FOUND)
+        for c in clients:
+            c.close()
+
+    def test_send_timeout(self):
+        size = 2**23
+        f = open(os.path.join(DATADIR, 'bar'), 'wb')
+        f.write(b'x' * size)
+        f.close()
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2**12)
+        s.settimeout(TIMEOUT)
+        s.connect((constants.DEFAULT_ADDR, self.PORT))
+        # Pedimos un slice grande y no lo leemos
+        s.send(('get_slice bar 0 %d\r\n' % size).encode("ascii"))
+        time.sleep(2)
+        data = self.read_until_closed(s)
+        self.assertLess(len(data), size * 4 // 3,
+                        "El server no cortó al cliente que no lee")
+        s.close()
+        c = self.new_client()
+        self.assertGreaterEqual(
+            c.stats().get('hftp_connections_reclaimed_total'
+                          '{reason="send_timeout"}', 0), 1)
+        c.close()
+
+
+class TestHFTPBackpressure(SpawnedServerBase):
+    """
+    Clientes que piden sin leer las respuestas, con pocos hilos para los
+    comandos baratos.
+    """
+
+    PORT = constants.DEFAULT_PORT + 3
+    SERVER_ARGS = ['--fast-workers', '2']
+
+    def test_non_reading_clients_dont_block_workers(self):
+        stalled = []
+        for i in range(4):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2**12)
+            s.settimeout(TIMEOUT)
+            s.connect((constants.DEFAULT_ADDR, self.PORT))
+            # Muchas más respuestas de las que entran en los buffers
+            s.sendall(b'stats\r\n' * 5000)
+            stalled.append(s)
+        time.sleep(1)
+        # Las colas de salida llenas no ocupan los hilos de los pools
+        c = self.new_client()
+        start = time.time()
+        self.assertEqual(c.get_metadata('does_not_exist'), None)
+        self.assertEqual(c.status, constants.FILE_NOT_FOUND)
+        self.assertLess(time.time() - start, 2)
+        c.close()
+        for s in stalled:
+            s.close()
+
+
+class TestHFTPReload(SpawnedServerBase):
+    """
+    Recarga con SIGHUP: el proceso nuevo lee la configuración actualizada
+    mientras el viejo termina los pedidos en curso.
+    """
+
+    PORT = constants.DEFAULT_PORT + 4
+    CONFIG = 'testreload.conf'
+    SERVER_ARGS = ['--config', CONFIG]
+
+    @classmethod
+    def setUpClass(cls):
+        with open(cls.CONFIG, 'w') as f:
+            f.write('# Configuración inicial\n--rate-limit 100000\n')
+        # El proceso nuevo no es hijo nuestro: lo terminamos por su grupo
+        cls.server = start_server(cls.PORT, cls.SERVER_ARGS,
+                                  start_new_session=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        try:
+            os.killpg(cls.server.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        cls.server.wait()
+        os.remove(cls.CONFIG)
+
+    def test_sighup_reload(self):
+        size = 400000
+        f = open(os.path.join(DATADIR, 'bar'), 'w')
+        f.write('x' * size)
+        f.close()
+        c = self.new_client()
+        c.send('get_slice bar 0 %d' % size)
+        self.assertEqual(c.read_response_line(TIMEOUT),
+                         (constants.CODE_OK, 'OK'))
+        # El slice dura unos segundos por el límite de ancho de banda
+        with open(self.CONFIG, 'w') as f:
+            f.write('--max-per-ip 1\n')
+        self.server.send_signal(signal.SIGHUP)
+        # Las conexiones nuevas las atiende el proceso nuevo, donde no está
+        # la conexión del slice
+        deadline = time.time() + TIMEOUT
+        while True:
+            probe = client.Client(constants.DEFAULT_ADDR, self.PORT)
+            if probe.stats().get('hftp_connections_active') == 1:
+                break
+            probe.close()
+            self.assertLess(time.time(), deadline,
+                            "El proceso nuevo no empezó a atender")
+            time.sleep(0.1)
+        # Con la configuración nueva
+        s = self.raw_connect()
+        busy = '%d %s\r\n' % (constants.SERVER_BUSY,
+                               constants.error_messages[constants.SERVER_BUSY])
+        self.assertEqual(self.read_until_closed(s), busy.encode("ascii"))
+        s.close()
+        probe.close()
+        # El pedido en curso en el proceso viejo termina, y después este sale
+        self.assertEqual(c.read_fragment(size), b'x' * size)
+        self.assertEqual(self.server.wait(TIMEOUT), 0)
+        c.s.close()
+        c.connected = False
+
+
+class TestHFTPLogging(SpawnedServerBase):
+    """
+    Access log en JSON con muestreo.
+    """
+
+    PORT = constants.DEFAULT_PORT + 5
+    LOG = 'testlog.json'
+    SERVER_ARGS = ['--log-level', 'INFO', '--log-json',
+                   '--log-sample', 'get_metadata=2']
+
+    @classmethod
+    def setUpClass(cls):
+        cls.log = open(cls.LOG, 'w')
+        cls.server = start_server(cls.PORT, cls.SERVER_ARGS, stderr=cls.log)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.log.close()
+        os.remove(cls.LOG)
+
+    def access_lines(self, command):
+        """
+        Devuelve los registros del access log del comando `command'.
+        """
+        with open(self.LOG) as f:
+            entries = [json.loads(line) for line in f]
+        return [entry for entry in entries
+                if entry["logger"] == "hftp.access"
+                and entry.get("command") == command]
+
+    def test_sampled_json_access_log(self):
+        open(os.path.join(DATADIR, 'bar'), 'w').close()
+        c = self.new_client()
+        for i in range(4):
+            self.assertEqual(c.get_metadata('bar'), 0)
+        self.assertEqual(c.get_metadata('does_not_exist'), None)
+        stats = c.stats()
+        self.assertEqual(stats.get('hftp_log_dropped_total'), 0)
+        c.close()
+        # Los registros se escriben desde un hilo de fondo
+        time.sleep(0.5)
+        entries = self.access_lines('get_metadata')
+        # Uno de cada dos pedidos exitosos, y todos los errores
+        self.assertEqual([entry["code"] for entry in entries],
+                         [constants.CODE_OK, constants.CODE_OK,
+                          constants.FILE_NOT_FOUND])
+        self.assertEqual(entries[0]["file"], 'bar')
+        self.assertEqual(entries[2]["file"], 'does_not_exist')
+
+
+class TestHFTPAcceptErrors(SpawnedServerBase):
+    """
+    Un server sin descriptores libres para aceptar conexiones.
+    """
+
+    PORT = constants.DEFAULT_PORT + 6
+    MAX_FILES = 32
+
+    @classmethod
+    def setUpClass(cls):
+        limit = (cls.MAX_FILES, cls.MAX_FILES)
+        cls.server = start_server(
+            cls.PORT, cls.SERVER_ARGS,
+            preexec_fn=lambda: resource.setrlimit(resource.RLIMIT_NOFILE, limit))
+
+    def test_accept_without_descriptors(self):
+        sockets = [socket.create_connection((constants.DEFAULT_ADDR, self.PORT))
+                   for i in range(self.MAX_FILES)]
+        time.sleep(0.5)
+        for s in sockets:
+            s.close()
+        # El server sigue atendiendo cuando se liberan los descriptores
+        c = self.new_client()
+        self.assertEqual(c.get_metadata('does_not_exist'), None)
+        self.assertEqual(c.status, constants.FILE_NOT_FOUND)
+        self.assertGreaterEqual(
+            c.stats().get('hftp_accept_errors_total{error="EMFILE"}', 0), 1)
+        c.close()
+
+
+class TestHFTPUnix(TestBase):
+
+    def setUp(self):
+        if UNIX_SOCKET is None:
+            self.skipTest("El server no escucha en un socket Unix "
+                          "(ver --unix-socket)")
+        super().setUp()
+
+    def new_client(self):
+        assert not hasattr(self, 'client')
+        try:
+            self.client = client.Client(unix_path=UNIX_SOCKET)
+        except socket.error:
+            self.fail("No se pudo establecer conexión al server por %s"
+                      % UNIX_SOCKET)
+        return self.client
+
+    def test_unix_metadata_and_slice(self):
+        self.output_file = 'bar'
+        test_data = 'x' * 100000
+        f = open(os.path.join(DATADIR, self.output_file), 'w')
+        f.write(test_data)
+        f.close()
+        c = self.new_client()
+        self.assertEqual(c.get_metadata(self.output_file), len(test_data))
+        c.retrieve(self.output_file)
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(open(self.output_file).read(), test_data)
+        c.close()
+        self.assertEqual(c.status, constants.CODE_OK)
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestHFTPServer))
     suite.addTest(unittest.makeSuite(TestHFTPErrors))
     suite.addTest(unittest.makeSuite(TestHFTPHard))
+    suite.addTest(unittest.makeSuite(TestHFTPv2))
+    suite.addTest(unittest.makeSuite(TestHFTPTimeouts))
+    suite.addTest(unittest.makeSuite(TestHFTPLimits))
+    suite.addTest(unittest.makeSuite(TestHFTPBackpressure))
+    suite.addTest(unittest.makeSuite(TestHFTPReload))
+    suite.addTest(unittest.makeSuite(TestHFTPLogging))
+    suite.addTest(unittest.makeSuite(TestHFTPAcceptErrors))
+    suite.addTest(unittest.makeSuite(TestHFTPUnix))
     return suite
 
 
 def main():
     import optparse
-    global DATADIR
+    global DATADIR, UNIX_SOCKET
     parser = optparse.OptionParser()
     parser.set_usage("%prog [opciones] [clases de tests]")
     parser.add_option('-d', '--datadir',
                       help="Directorio donde genera los datos; "
                       "CUIDADO: CORRER LOS TESTS *BORRA* LOS DATOS EN ESTE DIRECTORIO",
                       default=DATADIR)
+    parser.add_option('-u', '--unix-socket',
+                      help="Socket Unix del server, para probar también las "
+                      "conexiones locales", default=None)
     options, args = parser.parse_args()
     DATADIR = options.datadir
+    UNIX_SOCKET = options.unix_socket
     # Correr tests
     unittest.main(argv=sys.argv[0:1] + args)
 
@@ -6,27 +6,112 @@
 # Copyright 2008-2010 Natalia Bidart y Daniel Moisset
 # $Id: server.py 656 2013-03-18 23:49:11Z bc $
 
+import errno
 import optparse
+import resource
+import select
+import signal
+import subprocess
+import tempfile
+import selectors
+import shlex
 import socket
+import stat
 import connection
+import metrics
+import hftplog
+import ratelimit
+import executor
+import watcher
+import profiler
 from constants import *
 import sys
 import os
 import threading
+import time
+import logging
+
+logger = logging.getLogger("hftp.server")
+
+# Variables de entorno con las que un servidor le pasa al proceso que lo
+# reemplaza (ver Server.reload) los descriptores de los sockets donde
+# escucha, y el del pipe por el que el nuevo avisa que ya está atendiendo
+LISTEN_FDS_ENV = "HFTP_LISTEN_FDS"
+READY_FD_ENV = "HFTP_READY_FD"
 
 
 class Server(object):
     """
     El servidor, que crea y atiende el socket en la dirección y puerto
-    especificados donde se reciben nuevas conexiones de clientes.
+    especificados donde se reciben nuevas conexiones de clientes, y
+    opcionalmente un socket Unix para los clientes de la misma máquina.
     """
 
-    def __init__(self, addr=DEFAULT_ADDR, port=DEFAULT_PORT, directory=DEFAULT_DIR):
+    def __init__(self, addr=DEFAULT_ADDR, port=DEFAULT_PORT, directory=DEFAULT_DIR,
+                 metrics_port=None, metrics_addr=DEFAULT_METRICS_ADDR,
+                 rate_limit=None, global_rate_limit=None,
+                 idle_timeout=None, request_timeout=None, send_timeout=None,
+                 max_connections=0, max_per_ip=0,
+                 high_watermark=DEFAULT_HIGH_WATERMARK,
+                 low_watermark=DEFAULT_LOW_WATERMARK,
+                 fast_workers=DEFAULT_FAST_WORKERS,
+                 bulk_workers=DEFAULT_BULK_WORKERS,
+                 bulk_queue=DEFAULT_BULK_QUEUE,
+                 watch_interval=DEFAULT_WATCH_INTERVAL, watch_poll=False,
+                 unix_path=None, tcp=True, thread_stack_size=None,
+                 profile_dir=None, trace_spans=False,
+                 drain_timeout=DEFAULT_DRAIN_TIMEOUT, inherited=()):
         """
         Args:
             addr (str): Dirección IP del servidor.
             puerto (int): Puerto en el que el servidor aceptará conexiones entrantes.
             directorio (str): Directorio compartido que se servirá a los clientes.
+            metrics_port (int): Puerto HTTP donde exponer las métricas en
+                formato Prometheus. Si es None no se expone.
+            metrics_addr (str): Dirección donde escucha el endpoint de métricas.
+            rate_limit (int): Bytes por segundo de datos que puede recibir
+                cada conexión. None para no limitar.
+            global_rate_limit (int): Bytes por segundo de datos entre todas
+                las conexiones. None para no limitar.
+            idle_timeout (float): Segundos que una conexión puede estar sin
+                enviar nada antes de que se la cierre. None para no cerrarla.
+            request_timeout (float): Segundos que tiene un cliente para
+                completar una línea de pedido desde su primer byte.
+            send_timeout (float): Segundos que se espera a un cliente que no
+                lee lo que le enviamos antes de cerrar la conexión.
+            max_connections (int): Máximo de conexiones simultáneas, 0 sin límite.
+            max_per_ip (int): Máximo de conexiones simultáneas desde una misma
+                dirección, 0 sin límite. No se aplica al socket Unix.
+            high_watermark (int): Bytes pendientes de envío a partir de los
+                cuales una conexión deja de producir respuestas.
+            low_watermark (int): Bytes pendientes de envío por debajo de los
+                cuales una conexión vuelve a producir.
+            fast_workers (int): Hilos que atienden los comandos de control
+                y metadatos. 0 para atender cada comando en el hilo de su
+                conexión, sin pools.
+            bulk_workers (int): Hilos que atienden las transferencias
+                (get_slice, get_file_listing).
+            bulk_queue (int): Transferencias que pueden esperar un hilo libre
+                antes de que las conexiones que las piden se bloqueen.
+            watch_interval (float): Segundos entre snapshots del directorio
+                para el comando watch, cuando no se usa inotify.
+            watch_poll (bool): Usar snapshots aunque haya inotify.
+            unix_path (str): Ruta donde escuchar también en un socket Unix,
+                o None.
+            tcp (bool): False para escuchar solo en el socket Unix.
+            thread_stack_size (int): Tamaño en bytes de la pila de los hilos
+                que atienden conexiones y comandos, o None para el del
+                sistema. Con muchas conexiones ociosas, cada hilo reserva
+                su pila completa.
+            profile_dir (str): Directorio donde se escriben los resultados
+                del profiling a pedido. Por defecto, el temporal del sistema.
+            trace_spans (bool): Medir desde el arranque las etapas de cada
+                pedido (se puede cambiar con el comando profile).
+            drain_timeout (float): Segundos que se espera a los pedidos en
+                curso al recargar antes de cortar las conexiones.
+            inherited (list): Sockets ya vinculados que dejó el proceso
+                anterior en una recarga. Se usan los que coincidan con la
+                dirección, el socket Unix o el puerto de métricas pedidos.
 
         Raises:
             OSError: Si no se puede crear el directorio especificado.
@@ -36,40 +121,408 @@ class Server(object):
             try:
                 os.makedirs(directory)
             except OSError:
-                print("No se pudo crear el directorio %s." % directory)
+                logger.error("No se pudo crear el directorio %s.", directory)
                 sys.exit(1)
 
-        print(f'Serving "{directory}" directory on {addr}:{port}.')
+        if thread_stack_size is not None:
+            # Vale para todos los hilos que se creen de acá en más
+            threading.stack_size(thread_stack_size)
 
-        # Se crea el socket y se lo vincula a la dirección y puerto
-        oursocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # Permite reutilizar la dirección en caso de que el servidor se cierre
-        oursocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # Se vincula el socket a la dirección y puerto especificados
-        oursocket.bind((addr, port))
+        # Sockets donde se aceptan conexiones
+        self.inherited = list(inherited)
+        self.listeners = []
+        self.socket = None
+        if tcp:
+            logger.info('Serving "%s" directory on %s:%s.', directory, addr, port)
+            oursocket = self.inherit(socket.AF_INET,
+                                     (socket.gethostbyname(addr), port))
+            if oursocket is None:
+                # Se crea el socket y se lo vincula a la dirección y puerto
+                oursocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                # Permite reutilizar la dirección en caso de que el servidor se cierre
+                oursocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                # Se vincula el socket a la dirección y puerto especificados
+                oursocket.bind((addr, port))
+            self.socket = oursocket
+            self.listeners.append(oursocket)
+        self.unix_path = unix_path
+        if unix_path is not None:
+            logger.info('Serving "%s" directory on unix:%s.', directory, unix_path)
+            oursocket = self.inherit(socket.AF_UNIX, unix_path)
+            if oursocket is None:
+                oursocket = self.bind_unix(unix_path)
+            self.listeners.append(oursocket)
 
-        # Se guarda el socket y el directorio compartido en el objeto
-        self.socket = oursocket
+        # Se guarda el directorio compartido en el objeto
         self.directory = directory
 
-    def serve(self):
+        # Registro de métricas compartido por todas las conexiones
+        self.metrics = metrics.Metrics()
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = metrics.start_http_server(
+                self.metrics, metrics_addr, metrics_port,
+                self.inherit(socket.AF_INET,
+                             (socket.gethostbyname(metrics_addr), metrics_port)))
+            logger.info("Exporting metrics on http://%s:%s/metrics",
+                        metrics_addr, metrics_port)
+
+        # Limitación de ancho de banda para los datos de los slices
+        self.rate_limit = rate_limit
+        self.global_bucket = None
+        if global_rate_limit:
+            self.global_bucket = ratelimit.TokenBucket(global_rate_limit)
+        self.metrics.set_gauge('hftp_rate_limit_bytes{scope="connection"}',
+                               rate_limit or 0)
+        self.metrics.set_gauge('hftp_rate_limit_bytes{scope="global"}',
+                               global_rate_limit or 0)
+
+        # Protección contra clientes lentos o que acaparan conexiones
+        self.idle_timeout = idle_timeout
+        self.request_timeout = request_timeout
+        self.send_timeout = send_timeout
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        # Conexiones abiertas en total y por dirección. Con `idle' se
+        # espera a que se cierren todas al recargar.
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.active = 0
+        self.active_per_ip = {}
+        self.connections = set()
+        self.drain_timeout = drain_timeout
+
+        # Los comandos baratos no esperan detrás de las transferencias
+        self.executors = None
+        if fast_workers:
+            self.executors = executor.CommandExecutors(
+                self.metrics, fast_workers, bulk_workers, bulk_queue)
+
+        # Profiling a pedido, compartido por todas las conexiones
+        self.profiler = profiler.Profiler(profile_dir or tempfile.gettempdir(),
+                                          trace_spans)
+
+        # Un único watcher del directorio para todas las conexiones suscriptas
+        self.watcher = watcher.DirectoryWatcher(directory, watch_interval,
+                                                not watch_poll)
+
+        # Los sockets heredados que ya no se usan (cambió la configuración)
+        for oursocket in self.inherited:
+            oursocket.close()
+        self.inherited = []
+
+        # Las señales despiertan al loop de accept escribiendo en este par
+        self.wakeup = socket.socketpair()
+        for oursocket in self.wakeup:
+            oursocket.setblocking(False)
+
+    def inherit(self, family, address):
         """
-        Loop principal del servidor. Se acepta una conexión a la vez
-        y se espera a que concluya antes de seguir.
+        Devuelve el socket heredado de la familia `family' vinculado a
+        `address', o None si no hay ninguno.
         """
-        # Escucha conexiones entrantes con un máximo de 5 conexiones en cola
-        self.socket.listen(5)
+        for oursocket in self.inherited:
+            if oursocket.family == family and oursocket.getsockname() == address:
+                self.inherited.remove(oursocket)
+                logger.info("Inherited listening socket %s", address)
+                return oursocket
+        return None
+
+    @staticmethod
+    def bind_unix(path):
+        """
+        Crea un socket Unix vinculado a `path'. Si ya hay ahí un socket
+        que dejó otra ejecución, lo reemplaza.
+        """
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+        oursocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        oursocket.bind(path)
+        return oursocket
+
+    def install_signal_handlers(self, profile_seconds):
+        """
+        Con SIGUSR1 arranca un profiling por muestreo de `profile_seconds'
+        segundos, o termina el que esté en curso. Con SIGHUP se recarga:
+        ver reload().
+        """
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.profiler.toggle(
+                profiler.MODE_SAMPLE, profile_seconds))
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, lambda signum, frame: self._wake())
+
+    def _wake(self):
+        try:
+            self.wakeup[1].send(b"r")
+        except BlockingIOError:
+            # Ya hay una recarga pedida
+            pass
+
+    def close(self):
+        """
+        Deja de escuchar conexiones y borra el socket Unix.
+        """
+        for listener in self.listeners:
+            listener.close()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+        if self.unix_path is not None:
+            try:
+                os.unlink(self.unix_path)
+            except FileNotFoundError:
+                pass
+
+    def serve(self, ready_fd=None):
+        """
+        Loop principal del servidor. Acepta conexiones en todos los sockets
+        donde escucha y atiende cada una en su propio hilo.
+
+        Termina después de una recarga exitosa, cuando ya se drenaron las
+        conexiones. Si se pasa `ready_fd', escribe en él apenas empieza a
+        aceptar conexiones y lo cierra.
+        """
+        selector = selectors.DefaultSelector()
+        for listener in self.listeners:
+            # Escucha conexiones entrantes con la cola más larga que permita
+            # el sistema, para no perder conexiones en ráfagas
+            listener.listen(socket.SOMAXCONN)
+            selector.register(listener, selectors.EVENT_READ)
+        selector.register(self.wakeup[0], selectors.EVENT_READ)
+        if ready_fd is not None:
+            # Avisa al proceso que reemplazamos que ya puede dejar de aceptar
+            os.write(ready_fd, b"1")
+            os.close(ready_fd)
 
         while True:
             # Bloquea la ejecución hasta que se recibe una conexión entrante
-            (cnSocket, cnAdress) = self.socket.accept()
-            # Crea un objeto Connection para manejar la conexión entrante
-            cn = connection.Connection(cnSocket, self.directory)
-            print(f"Connected by: {cnAdress}")
-            # Creamos un nuevo hilo para manejar la conexión entrante
-            t = threading.Thread(target=cn.handle)
-            t.start()
+            for key, _ in selector.select():
+                if key.fileobj is not self.wakeup[0]:
+                    self.accept(key.fileobj)
+                    continue
+                self.wakeup[0].recv(4096)
+                if self.reload():
+                    selector.close()
+                    # Los sockets ahora son del proceso nuevo: el socket
+                    # Unix no se borra
+                    self.unix_path = None
+                    self.close()
+                    self.drain(self.drain_timeout)
+                    return
+
+    def reload(self):
+        """
+        Lanza un proceso nuevo del servidor con los mismos argumentos, que
+        hereda los sockets donde escuchamos y empieza a aceptar conexiones
+        en ellos de inmediato: las que lleguen mientras tanto esperan en la
+        cola del socket, no se rechazan. El proceso nuevo vuelve a leer el
+        archivo de --config, así que es la forma de cambiar la
+        configuración sin cortar el servicio (salvo los sockets, que se
+        heredan).
+
+        Returns:
+            True si el proceso nuevo ya está aceptando conexiones, o False
+            si no llegó a arrancar (y seguimos atendiendo nosotros).
+        """
+        sockets = list(self.listeners)
+        if self.metrics_server is not None:
+            sockets.append(self.metrics_server.socket)
+        fds = [oursocket.fileno() for oursocket in sockets]
+        ready_r, ready_w = os.pipe()
+        env = dict(os.environ)
+        env[LISTEN_FDS_ENV] = ",".join(str(fd) for fd in fds)
+        env[READY_FD_ENV] = str(ready_w)
+        logger.info("Reloading: starting a new server process")
+        try:
+            try:
+                child = subprocess.Popen([sys.executable] + sys.argv, env=env,
+                                         pass_fds=fds + [ready_w])
+            finally:
+                # Si el nuevo muere, la lectura de abajo devuelve EOF
+                os.close(ready_w)
+            readable, _, __ = select.select([ready_r], [], [], RELOAD_TIMEOUT)
+            ready = bool(readable) and os.read(ready_r, 1) == b"1"
+        except OSError:
+            logger.exception("Could not start a new server process")
+            return False
+        finally:
+            os.close(ready_r)
+        if not ready:
+            logger.error("New server process %d did not start, still serving",
+                         child.pid)
+            if child.poll() is None:
+                child.kill()
+            child.wait()
+            return False
+        logger.info("New server process %d is accepting connections", child.pid)
+        return True
 
+    def drain(self, timeout):
+        """
+        Cierra las conexiones abiertas a medida que terminan sus pedidos en
+        curso, sin atender pedidos nuevos. Las que siguen ocupadas pasados
+        `timeout' segundos se cortan.
+        """
+        with self.lock:
+            connections = list(self.connections)
+        logger.info("Draining %d connections", len(connections))
+        for cn in connections:
+            cn.drain()
+        with self.idle:
+            if self.idle.wait_for(lambda: not self.active, timeout):
+                return
+            connections = list(self.connections)
+        logger.warning("Closing %d connections still busy after %ss",
+                       len(connections), timeout)
+        for cn in connections:
+            cn.abort()
+
+    def accept(self, listener):
+        """
+        Acepta una conexión entrante en `listener' y lanza su hilo.
+        """
+        try:
+            (cnSocket, cnAdress) = listener.accept()
+        except OSError as e:
+            # Por ejemplo, una conexión que se cortó antes de aceptarla o
+            # falta de descriptores libres: no es motivo para dejar de servir
+            name = errno.errorcode.get(e.errno, "unknown")
+            logger.warning("Could not accept a connection: %s", e)
+            self.metrics.inc_counter(
+                'hftp_accept_errors_total{error="%s"}' % name)
+            if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS,
+                           errno.ENOMEM):
+                # La conexión sigue en la cola: esperamos a que se libere algo
+                # en lugar de volver a intentar enseguida
+                time.sleep(ACCEPT_BACKOFF)
+            return
+        if listener.family == socket.AF_UNIX:
+            # Los clientes locales no tienen dirección: no se los distingue
+            # entre sí, así que no cuentan para el límite por dirección
+            ip = None
+            peer = "unix"
+        else:
+            ip = cnAdress[0]
+            peer = "%s:%s" % cnAdress
+        reason = self.admit(ip)
+        if reason is not None:
+            self.reject(cnSocket, peer, reason)
+            return
+        # Crea un objeto Connection para manejar la conexión entrante
+        shaper = None
+        if self.rate_limit or self.global_bucket is not None:
+            shaper = ratelimit.Shaper(self.rate_limit, self.global_bucket)
+        cn = connection.Connection(cnSocket, self.directory, self.metrics,
+                                   peer, shaper,
+                                   idle_timeout=self.idle_timeout,
+                                   request_timeout=self.request_timeout,
+                                   send_timeout=self.send_timeout,
+                                   high_watermark=self.high_watermark,
+                                   low_watermark=self.low_watermark,
+                                   executors=self.executors,
+                                   watcher=self.watcher,
+                                   profiler=self.profiler)
+        logger.info("Connected by: %s", cn.peer)
+        self.metrics.connection_opened()
+        with self.lock:
+            self.connections.add(cn)
+        # Creamos un nuevo hilo para manejar la conexión entrante
+        t = threading.Thread(target=self.serve_connection, args=(cn, ip))
+        t.start()
+
+    def admit(self, ip):
+        """
+        Registra una nueva conexión desde `ip' si no supera los límites.
+        Con `ip' None (socket Unix) solo se controla el límite total.
+
+        Returns:
+            None si se la admite, o el motivo del rechazo.
+        """
+        with self.lock:
+            if self.max_connections and self.active >= self.max_connections:
+                return "max_connections"
+            if ip is not None:
+                count = self.active_per_ip.get(ip, 0)
+                if self.max_per_ip and count >= self.max_per_ip:
+                    return "max_per_ip"
+                self.active_per_ip[ip] = count + 1
+            self.active += 1
+        return None
+
+    def release(self, cn, ip):
+        """
+        Descuenta la conexión terminada `cn' de `ip'.
+        """
+        with self.lock:
+            self.connections.discard(cn)
+            self.active -= 1
+            if ip is not None:
+                count = self.active_per_ip[ip] - 1
+                if count:
+                    self.active_per_ip[ip] = count
+                else:
+                    del self.active_per_ip[ip]
+            if not self.active:
+                self.idle.notify_all()
+
+    def reject(self, cnSocket, peer, reason):
+        """
+        Rechaza una conexión por exceder los límites. El aviso al cliente
+        se envía sin bloquear, para no frenar el loop de accept.
+        """
+        logger.warning("Rejecting connection from %s (%s)", peer, reason)
+        self.metrics.inc_counter(
+            'hftp_connections_rejected_total{reason="%s"}' % reason)
+        try:
+            cnSocket.setblocking(False)
+            cnSocket.send(("%d %s%s" % (SERVER_BUSY, error_messages[SERVER_BUSY],
+                                        EOL)).encode("ascii"))
+        except OSError:
+            pass
+        cnSocket.close()
+
+    def serve_connection(self, cn, ip):
+        """
+        Atiende una conexión hasta que termina, manteniendo al día el
+        contador de conexiones activas.
+        """
+        try:
+            cn.handle()
+        finally:
+            self.release(cn, ip)
+            self.metrics.connection_closed()
+
+
+def inherited_sockets():
+    """
+    Devuelve los sockets que dejó el proceso anterior si este proceso lo
+    reemplaza en una recarga, y el descriptor por el que hay que avisarle
+    que ya estamos atendiendo (o None).
+    """
+    fds = os.environ.pop(LISTEN_FDS_ENV, "")
+    ready_fd = os.environ.pop(READY_FD_ENV, None)
+    sockets = [socket.socket(fileno=int(fd)) for fd in fds.split(",") if fd]
+    return sockets, int(ready_fd) if ready_fd is not None else None
+
+
+def raise_fd_limit():
+    """
+    Sube el límite de archivos abiertos al máximo permitido: cada conexión
+    ocupa un descriptor.
+    """
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            logger.info("Raised open file limit from %s to %s", soft, hard)
+    except (ValueError, OSError):
+        logger.warning("No se pudo subir el límite de archivos abiertos")
 
 
 # Punto de entrada del programa que lanza un servidor con protocolo HFTP
@@ -77,6 +530,12 @@ def main():
     """Parsea los argumentos y lanza el server"""
     # Configurar direccion IP, número de puerto y directorio compartido del servidor
     parser = optparse.OptionParser()
+    parser.add_option(
+        "-c", "--config", default=None,
+        help="Archivo con más opciones, escritas como en la línea de comandos "
+        "(en varias líneas y con comentarios #). Se vuelve a leer al recargar "
+        "con SIGHUP; las opciones de la línea de comandos tienen prioridad",
+    )
     parser.add_option(
         "-p", "--port", help="Número de puerto TCP donde escuchar", default=DEFAULT_PORT
     )
@@ -86,8 +545,140 @@ def main():
     parser.add_option(
         "-d", "--datadir", help="Directorio compartido", default=DEFAULT_DIR
     )
+    parser.add_option(
+        "-m", "--metrics-port",
+        help="Puerto HTTP donde exponer métricas (desactivado por defecto)",
+        default=None,
+    )
+    parser.add_option(
+        "--metrics-address",
+        help="Dirección donde escucha el endpoint de métricas",
+        default=DEFAULT_METRICS_ADDR,
+    )
+    parser.add_option(
+        "--rate-limit",
+        help="Bytes por segundo de datos por conexión (sin límite por defecto)",
+        default=None,
+    )
+    parser.add_option(
+        "--global-rate-limit",
+        help="Bytes por segundo de datos entre todas las conexiones "
+        "(sin límite por defecto)",
+        default=None,
+    )
+    parser.add_option(
+        "--idle-timeout", default=DEFAULT_IDLE_TIMEOUT,
+        help="Segundos sin actividad antes de cerrar una conexión (0 desactiva)",
+    )
+    parser.add_option(
+        "--request-timeout", default=DEFAULT_REQUEST_TIMEOUT,
+        help="Segundos para completar una línea de pedido (0 desactiva)",
+    )
+    parser.add_option(
+        "--send-timeout", default=DEFAULT_SEND_TIMEOUT,
+        help="Segundos esperando a un cliente que no lee (0 desactiva)",
+    )
+    parser.add_option(
+        "--max-connections", default=0,
+        help="Máximo de conexiones simultáneas (0 sin límite)",
+    )
+    parser.add_option(
+        "--max-per-ip", default=0,
+        help="Máximo de conexiones simultáneas por dirección (0 sin límite; "
+        "no se aplica al socket Unix)",
+    )
+    parser.add_option(
+        "--high-watermark", default=DEFAULT_HIGH_WATERMARK,
+        help="Bytes pendientes de envío por conexión a partir de los cuales "
+        "se deja de atender al cliente hasta que lea",
+    )
+    parser.add_option(
+        "--low-watermark", default=DEFAULT_LOW_WATERMARK,
+        help="Bytes pendientes de envío por conexión a los que hay que bajar "
+        "para volver a atender al cliente",
+    )
+    parser.add_option(
+        "--fast-workers", default=DEFAULT_FAST_WORKERS,
+        help="Hilos para los comandos de control y metadatos "
+        "(0 atiende los comandos en el hilo de cada conexión)",
+    )
+    parser.add_option(
+        "--bulk-workers", default=DEFAULT_BULK_WORKERS,
+        help="Hilos para las transferencias de datos",
+    )
+    parser.add_option(
+        "--bulk-queue", default=DEFAULT_BULK_QUEUE,
+        help="Transferencias que pueden esperar un hilo libre",
+    )
+    parser.add_option(
+        "-u", "--unix-socket", default=None,
+        help="Ruta de un socket Unix donde escuchar además de TCP",
+    )
+    parser.add_option(
+        "--no-tcp", action="store_true", default=False,
+        help="No escuchar en TCP (requiere --unix-socket)",
+    )
+    parser.add_option(
+        "--thread-stack-size", default=None,
+        help="Tamaño en KiB de la pila de cada hilo (por defecto, el del "
+        "sistema; como mínimo %d)" % (MIN_THREAD_STACK_SIZE // 1024),
+    )
+    parser.add_option(
+        "--profile-dir", default=None,
+        help="Directorio donde escribir los resultados del profiling "
+        "(por defecto, el temporal del sistema)",
+    )
+    parser.add_option(
+        "--profile-seconds", type="float", default=DEFAULT_PROFILE_SECONDS,
+        help="Duración del profiling que arranca la señal SIGUSR1",
+    )
+    parser.add_option(
+        "--trace-spans", action="store_true", default=False,
+        help="Mide las etapas de cada pedido (parse, validate, read, "
+        "encode, send) y las exporta en las métricas",
+    )
+    parser.add_option(
+        "--drain-timeout", default=DEFAULT_DRAIN_TIMEOUT,
+        help="Segundos que se espera a los pedidos en curso al recargar con "
+        "SIGHUP antes de cortar las conexiones",
+    )
+    parser.add_option(
+        "--watch-interval", default=DEFAULT_WATCH_INTERVAL,
+        help="Segundos entre snapshots del directorio para el comando watch "
+        "cuando no hay inotify",
+    )
+    parser.add_option(
+        "--watch-poll", action="store_true", default=False,
+        help="Usa snapshots del directorio para watch aunque haya inotify",
+    )
+    parser.add_option(
+        "--log-level",
+        help="Nivel de logging (valores posibles son: ERROR, WARN, INFO, DEBUG)",
+        default="INFO",
+    )
+    parser.add_option(
+        "--log-json", action="store_true", default=False,
+        help="Escribe los logs como objetos JSON, uno por línea",
+    )
+    parser.add_option(
+        "--log-sample",
+        help="Muestreo del access log, por ejemplo 'get_metadata=100,get_slice=10' "
+        "registra uno de cada N pedidos exitosos de cada comando",
+        default="",
+    )
     # Si se proporcionan argumentos extra, imprime la ayuda y sale del programa.
     options, args = parser.parse_args()
+    if options.config is not None:
+        try:
+            with open(options.config) as config:
+                config_args = shlex.split(config.read(), comments=True)
+        except (OSError, ValueError) as e:
+            sys.stderr.write("No se pudo leer la configuracion %s: %s\n"
+                             % (options.config, e))
+            sys.exit(1)
+        # Las opciones de la línea de comandos se leen después y pisan a las
+        # del archivo
+        options, args = parser.parse_args(config_args + sys.argv[1:])
     if len(args) > 0:
         parser.print_help()
         sys.exit(1)
@@ -98,10 +689,139 @@ def main():
         sys.stderr.write("Numero de puerto invalido: %s\n" % repr(options.port))
         parser.print_help()
         sys.exit(1)
-    # Crea un objeto servidor con IP, número de puerto y directorio especificados.
-    server = Server(options.address, port, options.datadir)
-    # Llama al método serve() para comenzar a escuchar conexiones entrantes.
-    server.serve()
+    if options.log_level not in hftplog.LOG_LEVELS:
+        sys.stderr.write("Nivel de logging invalido: %s\n" % repr(options.log_level))
+        parser.print_help()
+        sys.exit(1)
+    try:
+        sample_rates = hftplog.parse_sample_rates(options.log_sample)
+    except ValueError:
+        sys.stderr.write("Muestreo invalido: %s\n" % repr(options.log_sample))
+        parser.print_help()
+        sys.exit(1)
+    metrics_port = None
+    if options.metrics_port is not None:
+        try:
+            metrics_port = int(options.metrics_port)
+        except ValueError:
+            sys.stderr.write("Numero de puerto invalido: %s\n"
+                             % repr(options.metrics_port))
+            parser.print_help()
+            sys.exit(1)
+    try:
+        rate_limit = int(options.rate_limit) if options.rate_limit else None
+        global_rate_limit = (int(options.global_rate_limit)
+                             if options.global_rate_limit else None)
+    except ValueError:
+        sys.stderr.write("Limite de ancho de banda invalido\n")
+        parser.print_help()
+        sys.exit(1)
+    try:
+        # Un timeout de 0 significa esperar indefinidamente
+        idle_timeout = float(options.idle_timeout) or None
+        request_timeout = float(options.request_timeout) or None
+        send_timeout = float(options.send_timeout) or None
+        max_connections = int(options.max_connections)
+        max_per_ip = int(options.max_per_ip)
+    except ValueError:
+        sys.stderr.write("Timeout o limite de conexiones invalido\n")
+        parser.print_help()
+        sys.exit(1)
+    try:
+        high_watermark = int(options.high_watermark)
+        low_watermark = int(options.low_watermark)
+        if not 0 <= low_watermark < high_watermark:
+            raise ValueError
+    except ValueError:
+        sys.stderr.write("Marcas de agua invalidas\n")
+        parser.print_help()
+        sys.exit(1)
+    try:
+        fast_workers = int(options.fast_workers)
+        bulk_workers = int(options.bulk_workers)
+        bulk_queue = int(options.bulk_queue)
+        if fast_workers < 0 or bulk_workers < 1 or bulk_queue < 0:
+            raise ValueError
+    except ValueError:
+        sys.stderr.write("Cantidad de hilos invalida\n")
+        parser.print_help()
+        sys.exit(1)
+    thread_stack_size = None
+    if options.thread_stack_size is not None:
+        try:
+            thread_stack_size = int(options.thread_stack_size) * 1024
+            if thread_stack_size < MIN_THREAD_STACK_SIZE:
+                raise ValueError
+        except ValueError:
+            sys.stderr.write("Tamaño de pila invalido: %s\n"
+                             % repr(options.thread_stack_size))
+            parser.print_help()
+            sys.exit(1)
+    if options.profile_seconds <= 0:
+        sys.stderr.write("Duracion de profiling invalida\n")
+        parser.print_help()
+        sys.exit(1)
+    if options.no_tcp and options.unix_socket is None:
+        sys.stderr.write("--no-tcp requiere --unix-socket\n")
+        parser.print_help()
+        sys.exit(1)
+    try:
+        watch_interval = float(options.watch_interval)
+        if watch_interval <= 0:
+            raise ValueError
+    except ValueError:
+        sys.stderr.write("Intervalo de watch invalido\n")
+        parser.print_help()
+        sys.exit(1)
+    try:
+        drain_timeout = float(options.drain_timeout)
+        if drain_timeout < 0:
+            raise ValueError
+    except ValueError:
+        sys.stderr.write("Timeout de drenado invalido\n")
+        parser.print_help()
+        sys.exit(1)
+    # Los logs se escriben desde un hilo de fondo, fuera del camino de los pedidos
+    listener = hftplog.setup_logging(hftplog.LOG_LEVELS[options.log_level],
+                                     options.log_json, sample_rates)
+    raise_fd_limit()
+    inherited, ready_fd = inherited_sockets()
+    try:
+        # Crea un objeto servidor con IP, número de puerto y directorio especificados.
+        server = Server(options.address, port, options.datadir,
+                        metrics_port=metrics_port,
+                        metrics_addr=options.metrics_address,
+                        rate_limit=rate_limit,
+                        global_rate_limit=global_rate_limit,
+                        idle_timeout=idle_timeout,
+                        request_timeout=request_timeout,
+                        send_timeout=send_timeout,
+                        max_connections=max_connections,
+                        max_per_ip=max_per_ip,
+                        high_watermark=high_watermark,
+                        low_watermark=low_watermark,
+                        fast_workers=fast_workers,
+                        bulk_workers=bulk_workers,
+                        bulk_queue=bulk_queue,
+                        watch_interval=watch_interval,
+                        watch_poll=options.watch_poll,
+                        unix_path=options.unix_socket,
+                        tcp=not options.no_tcp,
+                        thread_stack_size=thread_stack_size,
+                        profile_dir=options.profile_dir,
+                        trace_spans=options.trace_spans,
+                        drain_timeout=drain_timeout,
+                        inherited=inherited)
+        # Los registros que no entran en la cola de logging se cuentan
+        hftplog.export_dropped(server.metrics)
+        server.install_signal_handlers(options.profile_seconds)
+        try:
+            # Llama al método serve() para comenzar a escuchar conexiones entrantes.
+            server.serve(ready_fd)
+        finally:
+            server.close()
+    finally:
+        listener.stop()
 
 
 if __name__ == "__main__":
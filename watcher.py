@@ -0,0 +1,231 @@
+# encoding: utf-8
+# Notificación de cambios en el directorio compartido del servidor HFTP.
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import threading
+import time
+from outqueue import wait_socket
+
+logger = logging.getLogger("hftp.watcher")
+
+# Tipos de evento que se notifican a los suscriptores
+EVENT_ADD = "add"
+EVENT_MODIFY = "modify"
+EVENT_DELETE = "delete"
+
+# Constantes de <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+INOTIFY_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                IN_CREATE | IN_DELETE)
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class InotifyBackend(object):
+    """
+    Fuente de eventos basada en inotify (solo Linux), usada con ctypes.
+    """
+
+    def __init__(self, directory):
+        """
+        Raises:
+            OSError: Si inotify no está disponible.
+        """
+        name = ctypes.util.find_library("c")
+        libc = ctypes.CDLL(name, use_errno=True) if name else None
+        if libc is None or not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify no disponible")
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory),
+                                  INOTIFY_MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch")
+        # Archivos creados que todavía no se terminaron de escribir: se
+        # anuncian al cerrarse, así el cliente no baja un archivo a medias
+        self.creating = set()
+
+    def poll(self, timeout):
+        """
+        Espera hasta `timeout' segundos y devuelve los eventos ocurridos,
+        como pares (evento, nombre).
+        """
+        if not wait_socket(self.fd, False, timeout):
+            return []
+        try:
+            data = os.read(self.fd, 2**16)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("Se perdieron eventos de inotify")
+                continue
+            event = self._translate(mask, os.fsdecode(name))
+            if event is not None:
+                events.append(event)
+        return events
+
+    def _translate(self, mask, name):
+        if mask & IN_CREATE:
+            if mask & IN_ISDIR:
+                return EVENT_ADD, name
+            self.creating.add(name)
+        elif mask & IN_CLOSE_WRITE:
+            if name in self.creating:
+                self.creating.discard(name)
+                return EVENT_ADD, name
+            return EVENT_MODIFY, name
+        elif mask & IN_MOVED_TO:
+            return EVENT_ADD, name
+        elif mask & IN_ATTRIB:
+            if name not in self.creating:
+                return EVENT_MODIFY, name
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            if name in self.creating:
+                # Nunca se anunció, así que tampoco se anuncia su borrado
+                self.creating.discard(name)
+                return None
+            return EVENT_DELETE, name
+        return None
+
+    def close(self):
+        os.close(self.fd)
+
+
+class SnapshotBackend(object):
+    """
+    Fuente de eventos portable: cada `timeout' segundos compara el tamaño
+    y la fecha de modificación de los archivos con los de la vez anterior.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                snapshot[entry.name] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def poll(self, timeout):
+        """
+        Espera `timeout' segundos y devuelve los cambios desde la última
+        llamada, como pares (evento, nombre).
+        """
+        time.sleep(timeout)
+        old, new = self.snapshot, self._scan()
+        self.snapshot = new
+        events = [(EVENT_DELETE, name) for name in old.keys() - new.keys()]
+        for name, identity in new.items():
+            previous = old.get(name)
+            if previous is None:
+                events.append((EVENT_ADD, name))
+            elif previous != identity:
+                events.append((EVENT_MODIFY, name))
+        return events
+
+    def close(self):
+        pass
+
+
+class DirectoryWatcher(object):
+    """
+    Vigila un directorio y reparte sus cambios entre los suscriptores.
+
+    Un solo hilo vigila el directorio para todos los suscriptores, y solo
+    mientras haya alguno. Los eventos vienen de inotify donde existe; si
+    no, de comparar snapshots del directorio cada `interval' segundos.
+    """
+
+    def __init__(self, directory, interval, use_inotify=True):
+        """
+        Args:
+            directory (str): Directorio a vigilar.
+            interval (float): Segundos entre snapshots, si no hay inotify.
+                Con inotify, cada cuánto revisa si quedan suscriptores.
+            use_inotify (bool): False para usar siempre los snapshots.
+        """
+        self.directory = directory
+        self.interval = interval
+        self.use_inotify = use_inotify
+        self.lock = threading.Lock()
+        self.subscribers = []
+        # Evento para detener el hilo que vigila, o None si no hay ninguno
+        self.stop = None
+
+    def subscribe(self, callback):
+        """
+        Registra `callback', que se llamará como callback(evento, nombre)
+        por cada cambio en el directorio. Se llama desde el hilo del
+        watcher, así que no debe bloquearse.
+        """
+        with self.lock:
+            self.subscribers.append(callback)
+            if self.stop is None:
+                # La fuente se abre acá para no perder los cambios que
+                # ocurran mientras arranca el hilo
+                backend = self._open_backend()
+                self.stop = threading.Event()
+                threading.Thread(target=self._run, args=(backend, self.stop),
+                                 name="hftp-watcher", daemon=True).start()
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+            if not self.subscribers and self.stop is not None:
+                # El hilo termina en cuanto vuelva de esperar eventos; si
+                # mientras tanto llega otro suscriptor, arranca uno nuevo
+                self.stop.set()
+                self.stop = None
+
+    def _open_backend(self):
+        if self.use_inotify:
+            try:
+                return InotifyBackend(self.directory)
+            except OSError as e:
+                logger.info("Sin inotify (%s), se usan snapshots", e)
+        return SnapshotBackend(self.directory)
+
+    def _run(self, backend, stop):
+        try:
+            while not stop.is_set():
+                events = backend.poll(self.interval)
+                with self.lock:
+                    if stop.is_set():
+                        return
+                    subscribers = list(self.subscribers)
+                for event, name in events:
+                    for callback in subscribers:
+                        callback(event, name)
+        except Exception:
+            logger.exception("Error vigilando %s", self.directory)
+            with self.lock:
+                if self.stop is stop:
+                    self.stop = None
+        finally:
+            backend.close()